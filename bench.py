@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+##
+## sisoap - python lisp: solution in search of a problem
+##       https://github.com/minmus-9/sisoap
+## Copyright (C) 2025  Mark Hays (github:minmus-9)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"benchmark suite with baseline regression checks"
+
+## pylint: disable=invalid-name
+## XXX pylint: disable=missing-docstring
+
+import contextlib
+import gc
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+from lcore import EL, Context, Parser, parse, read_file
+from lisp import RUNTIME, create_base
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+## {{{ workloads
+
+## each workload is make(engine, base) -> (ctx, run): make does the
+## untimed setup in a fresh context on top of base and run() is what's
+## timed
+
+
+def example(name, tail=None):
+    ## run examples/name.lisp; tail replaces its last form, for files
+    ## that end by running forever
+    path = os.path.join(HERE, "examples", name + ".lisp")
+
+    def make(engine, base):
+        ctx = Context(engine, base=base)
+        forms = read_file(ctx, path, mapped=False)
+        if tail is not None:
+            forms[-1:] = []
+            parse(ctx, tail, forms.append)
+
+        def run():
+            for x in forms:
+                ctx.leval(x)
+
+        return ctx, run
+
+    return make
+
+
+def snippet(setup, expr):
+    ## evaluate setup untimed, then time expr
+    def make(engine, base):
+        ctx = Context(engine, base=base)
+        parse(ctx, setup, ctx.leval)
+        forms = []
+        parse(ctx, expr, forms.append)
+        x = forms[0]
+
+        def run():
+            ctx.leval(x)
+
+        return ctx, run
+
+    return make
+
+
+def parsing(engine, base):
+    ## parser throughput on the runtime and the examples
+    texts = [RUNTIME]
+    for path in sorted(glob.glob(os.path.join(HERE, "examples", "*.lisp"))):
+        with open(path, "r", encoding="utf-8") as fp:
+            texts.append(fp.read())
+    text = "\n".join(texts) * 4
+    ctx = Context(engine, base=base)
+
+    def run():
+        forms = []
+        p = Parser(ctx, forms.append)
+        p.feed(text)
+        p.feed(None)
+
+    return ctx, run
+
+
+def stringify(engine, base):
+    ## a long list of small lists of numbers, symbols and strings
+    ctx = Context(engine, base=base)
+    x = EL
+    for i in range(4000):
+        x = [[i, [ctx.symbol(f"s{i % 50}"), [str(i), EL]]], x]
+
+    def run():
+        ctx.stringify(x)
+
+    return ctx, run
+
+
+def embedding(how):
+    ## 10000 calls of a small function from python, so the run time in
+    ## ms is the per-call overhead in units of 100ns
+    def make(engine, base):
+        ctx = Context(engine, base=base)
+        parse(ctx, "(define (inc n) (+ n 1))", ctx.leval)
+        forms = []
+        parse(ctx, "(inc 1)", forms.append)
+        x = forms[0]
+        inc = ctx.leval(ctx.symbol("inc"))
+
+        if how == "leval":
+
+            def run():
+                for _ in range(10000):
+                    ctx.leval(x)
+
+        else:
+
+            def run():
+                for _ in range(10000):
+                    ctx.call(inc, 1)
+
+        return ctx, run
+
+    return make
+
+
+WORKLOADS = {
+    "deriv": example("deriv"),
+    "factorial": example("factorial"),
+    "pi": example("pi"),
+    "primes": example("primes"),
+    "sicp": example("sicp"),
+    "stream": example("stream", "(stream-ref fibs 400)"),
+    "parse": parsing,
+    "lookup": snippet(
+        """
+        (define g 1)
+        (define (lookup n)
+            (let ((a 1))
+                (let ((b 2))
+                    (define (loop i acc)
+                        (if (< i n) (loop (+ i 1) (+ acc a b g)) acc))
+                    (loop 0 0))))
+        """,
+        "(lookup 20000)",
+    ),
+    "callcc": snippet(
+        """
+        (define (cc n)
+            (define (loop i acc)
+                (if
+                    (< i n)
+                    (loop (+ i 1) (+ acc (call/cc (lambda (k) (k i)))))
+                    acc))
+            (loop 0 0))
+        """,
+        "(cc 10000)",
+    ),
+    "closures": snippet(
+        """
+        (define (adder k) (lambda (x) (+ x k)))
+        (define (closures n)
+            (define (loop i acc)
+                (if (< i n) (loop (+ i 1) ((adder i) acc)) acc))
+            (loop 0 0))
+        """,
+        "(closures 20000)",
+    ),
+    "ffi": snippet(
+        """
+        (define (ffi n)
+            (define (loop i acc)
+                (if (< i n) (loop (+ i 1) (+ acc (math 'sqrt i))) acc))
+            (loop 0 0))
+        """,
+        "(ffi 5000)",
+    ),
+    "stringify": stringify,
+    "leval": embedding("leval"),
+    "call": embedding("call"),
+}
+
+## }}}
+## {{{ runner
+
+
+def measure(make, engine, base, reps, warmup):
+    ## timings of reps runs after warmup, and the step count of one
+    ## more run through the counting trampoline
+    times = []
+    with open(os.devnull, "w", encoding="utf-8") as null:
+        with contextlib.redirect_stdout(null):
+            for i in range(warmup + reps):
+                ctx, run = make(engine, base)
+                if ctx.engine != engine:
+                    raise RuntimeError(
+                        f"workload ran under {ctx.engine}, not {engine}"
+                    )
+                gc.collect()
+                t = time.perf_counter()
+                run()
+                t = time.perf_counter() - t
+                if i >= warmup:
+                    times.append(t)
+            ctx, run = make(engine, base)
+            ctx.instrument()
+            run()
+            steps = ctx.stats()["steps"]
+    median = statistics.median(times)
+    return {
+        "median": median,
+        "min": min(times),
+        "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "reps": reps,
+        "steps": steps,
+        "steps_per_sec": steps / median if steps else None,
+    }
+
+
+def compare(results, baseline, threshold):
+    ## (engine, name, old, new) for each median more than threshold
+    ## slower than the baseline's
+    ret = []
+    for engine, res in results.items():
+        old = baseline.get("results", {}).get(engine, {})
+        for name, r in res.items():
+            if name in old:
+                o, n = old[name]["median"], r["median"]
+                if n > o * (1 + threshold):
+                    ret.append((engine, name, o, n))
+    return ret
+
+
+def report(engine, res):
+    print(f"engine={engine}")
+    print(
+        f"{'workload':<12} {'median ms':>10} {'min ms':>10}"
+        f" {'stddev ms':>10} {'steps/s':>12}"
+    )
+    for name, r in res.items():
+        sps = r["steps_per_sec"]
+        sps = "-" if sps is None else f"{sps:12.0f}"
+        print(
+            f"{name:<12} {r['median'] * 1e3:10.2f} {r['min'] * 1e3:10.2f}"
+            f" {r['stddev'] * 1e3:10.2f} {sps:>12}",
+            flush=True,
+        )
+
+
+def main():
+    ## pylint: disable=too-many-branches,too-many-locals
+    engines = ["interp"]
+    names = list(WORKLOADS)
+    reps, warmup, threshold = 5, 1, 0.10
+    out = baseline = None
+    for opt in sys.argv[1:]:
+        if opt.startswith("--engine="):
+            engines = opt[9:].split(",")
+        elif opt.startswith("--only="):
+            names = opt[7:].split(",")
+            for name in names:
+                if name not in WORKLOADS:
+                    raise SystemExit(f"unknown workload {name!r}")
+        elif opt.startswith("--reps="):
+            reps = int(opt[7:])
+        elif opt.startswith("--warmup="):
+            warmup = int(opt[9:])
+        elif opt.startswith("--json="):
+            out = opt[7:]
+        elif opt.startswith("--baseline="):
+            with open(opt[11:], "r", encoding="utf-8") as fp:
+                baseline = json.load(fp)
+        elif opt.startswith("--threshold="):
+            threshold = float(opt[12:])
+        elif opt == "--list":
+            print(" ".join(WORKLOADS))
+            return
+        else:
+            raise SystemExit(f"unknown option {opt!r}")
+
+    results = {}
+    for engine in engines:
+        base = create_base(engine)
+        res = results[engine] = {}
+        for name in names:
+            res[name] = measure(WORKLOADS[name], engine, base, reps, warmup)
+        report(engine, res)
+
+    if out is not None:
+        with open(out, "w", encoding="utf-8") as fp:
+            json.dump(
+                {
+                    "python": sys.version.split()[0],
+                    "reps": reps,
+                    "warmup": warmup,
+                    "results": results,
+                },
+                fp,
+                indent=1,
+            )
+            fp.write("\n")
+
+    if baseline is not None:
+        bad = compare(results, baseline, threshold)
+        for engine, name, o, n in bad:
+            print(
+                f"REGRESSION {engine} {name}: {o * 1e3:.2f} ms ->"
+                f" {n * 1e3:.2f} ms ({n / o - 1:+.0%})"
+            )
+        if bad:
+            raise SystemExit(1)
+        print(f"no regressions over {threshold:.0%}")
+
+
+## }}}
+
+
+if __name__ == "__main__":
+    main()
+
+## EOF
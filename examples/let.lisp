@@ -0,0 +1,56 @@
+;; let.lisp - benchmark let, let* and letrec in a hot loop
+;;
+;; sisoap - python lisp: solution in search of a problem
+;;       https://github.com/minmus-9/sisoap
+;; Copyright (C) 2025  Mark Hays (github:minmus-9)
+;; 
+;; This program is free software: you can redistribute it and/or modify
+;; it under the terms of the GNU General Public License as published by
+;; the Free Software Foundation, either version 3 of the License, or
+;; (at your option) any later version.
+;; 
+;; This program is distributed in the hope that it will be useful,
+;; but WITHOUT ANY WARRANTY; without even the implied warranty of
+;; MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+;; GNU General Public License for more details.
+;; 
+;; You should have received a copy of the GNU General Public License
+;; along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+;; the shape of bench.lisp's (two): a let binding a few calls
+(define (one x) (mul x 3))
+
+(define (two n)
+    (let
+        ((x (one n))
+         (y (one n))
+         (z (sub n 1)))
+        x
+    )
+)
+
+(define (lets n)
+    (cond
+        ((lt? n 1) ())
+        (#t (two n) (lets (sub n 1)))
+    )
+)
+
+(define (stars n)
+    (let* ((m (sub n 1)) (k (mul m 2)))
+        (if (lt? m 1) k (stars m))
+    )
+)
+
+(define (recs n)
+    (letrec
+        ((down (lambda (i) (if (lt? i 1) i (down (sub i 1))))))
+        (down n)
+    )
+)
+
+(print 'let (timeit (lambda (_) (lets 2000)) 10))
+(print 'let* (timeit (lambda (_) (stars 2000)) 10))
+(print 'letrec (timeit (lambda (_) (recs 2000)) 10))
+
+;; EOF
@@ -33,45 +33,121 @@ optimizing. Also, using pairs for the stack is a lot faster than the more
 obvious list.append()/lisp.pop() function calls.
 """
 
-## pylint: disable=invalid-name
+## pylint: disable=invalid-name, too-many-lines
 ## XXX pylint: disable=missing-docstring
 
+import collections
+import hashlib
 import locale
+import marshal
+import mmap
 import os
+import re
+import stat
 import sys
+import time
 import traceback
 
 ## {{{ exports
 
 __all__ = (
+    "BUDGET_BATCH",
+    "Base",
+    "Budget",
+    "BudgetExceeded",
     "Context",
     "EL",
+    "ENGINES",
+    "Frame",
+    "Globals",
+    "Label",
+    "Mark",
     "Parser",
+    "Profiled",
+    "Profiler",
     "SENTINEL",
+    "Scope",
+    "Stats",
     "Symbol",
     "T",
+    "Trap",
+    "ast_decode",
+    "ast_encode",
+    "budget_base",
+    "cache_read",
+    "cache_write",
     "car",
     "cdr",
+    "cmpl",
+    "compile_assign",
+    "compile_attempt",
+    "compile_call_steps",
+    "compile_constant",
+    "compile_define",
+    "compile_direct",
+    "compile_expr",
+    "compile_lambda",
+    "compile_seq2",
+    "compile_sequence",
     "cons",
+    "create_compiled_lambda",
     "create_continuation",
     "create_environment",
     "create_lambda",
+    "create_vm_lambda",
+    "env_assign",
+    "env_items",
     "eq",
     "error",
     "execute",
     "ffi",
     "glbl",
     "is_atom",
+    "k_await",
+    "k_budget_done",
+    "k_land",
     "k_leval",
+    "k_prof_return",
     "k_stringify",
+    "k_task_next",
+    "k_task_run_all",
+    "k_trap_done",
+    "leaf",
     "load",
     "main",
     "parse",
+    "parse_file",
+    "parse_mapped",
+    "push_budget",
+    "push_trap",
+    "read_file",
     "repl",
+    "scan_defines",
     "set_car",
     "set_cdr",
+    "snapshot_dump",
+    "snapshot_globals",
+    "snapshot_key",
+    "snapshot_load",
+    "snapshot_maker",
     "spcl",
     "symcheck",
+    "task_new",
+    "task_queue",
+    "task_switch",
+    "task_wake",
+    "trap_message",
+    "vm_compile",
+    "vm_compile_assign",
+    "vm_compile_closure",
+    "vm_compile_constant",
+    "vm_compile_define",
+    "vm_compile_if",
+    "vm_compile_lambda",
+    "vm_compile_let",
+    "vm_compile_letrec",
+    "vm_compile_sequence",
+    "vmcmpl",
 )
 
 ## }}}
@@ -82,6 +158,15 @@ class error(Exception):
     pass
 
 
+class BudgetExceeded(Exception):
+    ## a Budget ran out, see Context.trampoline_budget(). trap can't
+    ## catch this, only the with-budget that set it up
+
+    def __init__(self, budget, what):
+        super().__init__(f"{what} exceeded")
+        self.budget = budget
+
+
 EL = object()
 T = True
 SENTINEL = object()
@@ -119,14 +204,29 @@ def symcheck(x):
 ## {{{ symbol table
 
 
-def create_symbol_table():
+def create_symbol_table(base=None):
+    ## base is the symbol() of a Base, whose symbols take precedence
     t = {}
 
-    def symbol(s):
-        if s not in t:
-            t[s] = Symbol(s)
-        return t[s]
+    if base is None:
+
+        def symbol(s):
+            if s not in t:
+                t[s] = Symbol(s)
+            return t[s]
 
+    else:
+        b = base.table
+
+        def symbol(s):
+            x = b.get(s)
+            if x is None:
+                x = t.get(s)
+                if x is None:
+                    x = t[s] = Symbol(s)
+            return x
+
+    symbol.table = t
     return symbol
 
 
@@ -194,6 +294,71 @@ def create_environment(ctx, params, args, parent):
         raise SyntaxError("expected list") from None
 
 
+class Globals(dict):
+    ## the global env. every store bumps ver so that compiled code can
+    ## cache global lookups per reference; see compile_symbol(). the one
+    ## exception is global_miss() copying a base binding. shadowed
+    ## collects names that were ever bound in a Frame's overflow dict.
+    ## a frozen Globals is the shared env of a Base and can't be changed.
+
+    __slots__ = ("ver", "shadowed", "frozen")
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.ver = 0
+        self.shadowed = set()
+        self.frozen = False
+
+    def __setitem__(self, sym, value):
+        if self.frozen:
+            raise TypeError(f"cannot bind {sym} in a frozen env")
+        self.ver += 1
+        dict.__setitem__(self, sym, value)
+
+    def __delitem__(self, sym):
+        if self.frozen:
+            raise TypeError(f"cannot unbind {sym} in a frozen env")
+        self.ver += 1
+        dict.__delitem__(self, sym)
+
+
+class Base:
+    ## pylint: disable=too-few-public-methods
+    ## a global env, symbol table, and quote table frozen so that any
+    ## number of Contexts can share them; see Context(base=...). each of
+    ## those gets a small global env of its own whose parent is base.g,
+    ## so define and set! stay private to it. the base's own lambdas
+    ## still see the base's bindings, not a context's. ctx must not be
+    ## used after this, its global env is read-only now.
+
+    __slots__ = ("engine", "g", "symbol", "q")
+
+    def __init__(self, ctx):
+        ctx.g.frozen = True
+        self.engine = ctx.engine
+        self.g = ctx.g
+        self.symbol = ctx.symbol
+        self.q = ctx.q
+
+
+class Stats:
+    ## pylint: disable=too-few-public-methods
+    ## what Context.trampoline_counted collects: bounces per continuation
+    ## (by qualified name so closures made over and over don't pile up),
+    ## and steps and wall time per top level run. a nested trampoline,
+    ## e.g. from trap or an ffi callback, is part of the run around it.
+    ## hist maps steps.bit_length() to the number of runs.
+
+    __slots__ = ("counts", "depth", "hist", "last", "runs", "steps", "time")
+
+    def __init__(self):
+        self.counts = {}
+        self.depth = self.runs = self.steps = 0
+        self.hist = {}
+        self.last = (0, 0.0)
+        self.time = 0.0
+
+
 ## }}}
 ## {{{ decorators and global decl table
 
@@ -204,7 +369,7 @@ G__ = {}
 def glbl(name):
     def wrap(func):
         G__[name] = func
-        func.special = func.ffi = False
+        func.special = func.ffi = func.leaf = False
         return func
 
     return wrap
@@ -214,7 +379,7 @@ def spcl(name):
     def wrap(func):
         G__[name] = func
         func.special = True
-        func.ffi = False
+        func.ffi = func.leaf = False
         return func
 
     return wrap
@@ -223,55 +388,183 @@ def spcl(name):
 def ffi(name):
     def wrap(func):
         G__[name] = func
-        func.special = False
+        func.special = func.leaf = False
         func.ffi = True
         return func
 
     return wrap
 
 
+def leaf(func):
+    ## mark a primitive that only sets ctx.val and returns ctx.cont
+    ## without touching the stack, so compiled code can call it inline
+    func.leaf = True
+    return func
+
+
+def cmpl(spec):
+    ## attach a closure compiler to the special form spec
+
+    def wrap(func):
+        spec.compile = func
+        return func
+
+    return wrap
+
+
+def vmcmpl(spec):
+    ## attach a register machine compiler to the special form spec
+
+    def wrap(func):
+        spec.vmcompile = func
+        return func
+
+    return wrap
+
+
 ## }}}
 ## {{{ context
 
 
 class Context:
     ## pylint: disable=too-many-instance-attributes
-
-    __slots__ = ("argl", "cont", "env", "exp", "val", "s", "symbol", "g", "q")
-
-    def __init__(self):
+    ## pylint: disable=too-many-public-methods
+
+    __slots__ = (
+        "argl",
+        "budget",
+        "cont",
+        "engine",
+        "env",
+        "exp",
+        "val",
+        "s",
+        "symbol",
+        "g",
+        "q",
+        "lam",
+        "prof",
+        "runs",
+        "stats_",
+        "tasks",
+        "trampoline",
+    )
+
+    def __init__(self, engine=None, base=None):
         ## registers
         self.argl = self.cont = self.env = self.exp = self.val = EL
         ## stack
         self.s = EL
-        ## symbols
-        self.symbol = create_symbol_table()
-        ## global env
-        symbol = self.symbol
-        self.g = genv = create_environment(self, EL, EL, SENTINEL)
-        genv[symbol("#t")] = T
-        for k, v in G__.items():
-            genv[symbol(k)] = v
-        ## quote-to-symbol table
-        self.q = {
-            "'": self.symbol("quote"),
-            ",": self.symbol("unquote"),
-            ",@": self.symbol("unquote-splicing"),
-            "`": self.symbol("quasiquote"),
-        }
+        if base is not None:
+            ## layer a private global env on the shared one
+            self.symbol = create_symbol_table(base.symbol)
+            self.g = Globals({SENTINEL: base.g})
+            self.q = base.q
+        else:
+            ## symbols
+            self.symbol = create_symbol_table()
+            ## global env
+            symbol = self.symbol
+            self.g = genv = Globals({SENTINEL: SENTINEL})
+            genv[symbol("#t")] = T
+            for k, v in G__.items():
+                genv[symbol(k)] = v
+            ## quote-to-symbol table
+            self.q = {
+                "'": self.symbol("quote"),
+                ",": self.symbol("unquote"),
+                ",@": self.symbol("unquote-splicing"),
+                "`": self.symbol("quasiquote"),
+            }
+        ## lambda factory for op_lambda and friends, by default the
+        ## base's engine
+        if engine is None:
+            engine = "interp" if base is None else base.engine
+        self.engine = engine
+        try:
+            self.lam = ENGINES[engine](self)
+        except KeyError:
+            raise ValueError(f"unknown engine {engine!r}") from None
+        ## see Profiler
+        self.prof = None
+        ## see instrument()
+        self.stats_ = None
+        ## green threads waiting to run, see task_queue()
+        self.tasks = None
+        ## trampoline runs in progress, see run_begin()
+        self.runs = 0
+        ## innermost limit, see trampoline_budget()
+        self.budget = None
+        self.trampoline = self.trampoline_plain
 
     ## top level
 
-    def leval(self, x, env=SENTINEL):
-        self.cont = self.land
+    def leval(self, x, env=SENTINEL, max_steps=None, deadline=None):
+        ## with max_steps (bounces) or deadline (a time.monotonic()
+        ## value), raise BudgetExceeded if x takes longer than that
+        self.cont = k_land
         self.exp = x
         self.env = self.g if env is SENTINEL else env
-        return self.trampoline(k_leval)
+        if max_steps is None and deadline is None:
+            return self.trampoline(k_leval)
+        saved = self.run_begin()
+        base = self.s
+        self.budget = Budget(max_steps, deadline, saved[0])
+        failed = False
+        try:
+            return self.trampoline_budget(k_leval, base)
+        except BudgetExceeded:
+            ## drop what was abandoned
+            self.s = base
+            failed = True
+            raise
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.run_end(saved, failed)
+
+    def call(self, proc, *args):
+        ## apply a lisp procedure to python args (not converted) without
+        ## building an expression to evaluate. like leval, running this
+        ## from inside a computation clobbers cont and env
+        return self.trampoline(self.call_setup(proc, args))
+
+    def call_setup(self, proc, args):
+        if proc.special:
+            raise TypeError(f"cannot call special form {proc!r}")
+        argl = EL
+        for x in reversed(args):
+            argl = [x, argl]
+        self.argl = argl
+        self.cont = k_land
+        if proc.ffi:
+            self.exp = proc
+            return k_ffi
+        return proc
+
+    ## asyncio versions of the above: they give the event loop a turn
+    ## every `steps` bounces, or if timeslice is given, every `steps`
+    ## bounces once timeslice seconds have passed since the last turn,
+    ## and await what ffi functions return if it is awaitable. a ctx
+    ## runs one computation at a time, so give each task its own, e.g.,
+    ## Context(base=...)
+
+    async def aleval(self, x, env=SENTINEL, steps=1000, timeslice=None):
+        self.cont = k_land
+        self.exp = x
+        self.env = self.g if env is SENTINEL else env
+        return await self.atrampoline(k_leval, steps, timeslice)
+
+    async def acall(self, proc, *args, steps=1000, timeslice=None):
+        func = self.call_setup(proc, args)
+        return await self.atrampoline(func, steps, timeslice)
 
     def stringify(self, x):
-        self.cont = self.land
+        self.cont = k_land
         self.exp = x
-        return self.trampoline(k_stringify)
+        ## not a run of its own as far as stats() is concerned
+        return self.trampoline_plain(k_stringify)
 
     ## stack
 
@@ -297,18 +590,280 @@ class Context:
 
     ## trampoline
 
-    def trampoline(self, func):
+    ## self.trampoline is one of these two, so that counting costs
+    ## nothing unless it is turned on
+
+    ## a computation ends by continuing to k_land. checking for that
+    ## is cheaper than raising an exception out of the loop per leval,
+    ## which matters when embedding code makes many small calls
+
+    def run_begin(self):
+        ## a trampoline run starts, returns what run_end() restores. one
+        ## inside another run gets a run queue of its own: the tasks
+        ## queued outside may include the computation that called it
+        saved = self.budget, self.tasks
+        if self.runs:
+            self.tasks = None
+        self.runs += 1
+        return saved
+
+    def run_end(self, saved, failed):
+        ## a with-budget that an error took us out of must not outlive
+        ## the run. tasks a nested run left queued go on in the run
+        ## around it, the top level keeps them for the next leval. an
+        ## error out of the top level drops them all, along with those
+        ## blocked on channels, see chan_waiter() in lisp.py
+        self.budget, tasks = saved
+        self.runs -= 1
+        if failed:
+            self.tasks = tasks if self.runs else None
+        elif self.runs:
+            left, self.tasks = self.tasks, tasks
+            if left:
+                if tasks is None:
+                    self.tasks = left
+                else:
+                    tasks.extend(left)
+
+    def trampoline_plain(self, func):
+        land = k_land
+        base = self.s
+        saved = self.run_begin()
+        failed = False
         try:
             while True:
-                func = func(self)
-        except self.Land:
-            return self.val
-
-    def land(self, _):
-        raise self.Land()
+                try:
+                    while func is not land:
+                        func = func(self)
+                    if self.budget is None or self.budget.resume is None:
+                        return self.val
+                    ## with-budget: go on where limits are enforced
+                    return self.trampoline_budget(land, base)
+                except Exception as exc:  ## pylint: disable=broad-except
+                    func = self.unwind(exc, base)
+                    if func is None:
+                        raise
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.run_end(saved, failed)
+
+    def trampoline_budget(self, func, base):
+        ## like trampoline_plain, but charges bounces to ctx.budget and
+        ## the budgets around it in batches, see budget_charge(). when
+        ## with-budget pushes a budget, it lands with the func to go on
+        ## with in budget.resume
+        land = k_land
+        done = n = batch = 0
+        while True:
+            try:
+                n = batch = self.budget_charge(done)
+                while func is not land:
+                    func = func(self)
+                    n -= 1
+                    if not n:
+                        n = batch = self.budget_charge(batch)
+                b = self.budget
+                if b is None or b.resume is None:
+                    return self.val
+                func, b.resume = b.resume, None
+                done = batch - n
+            except BudgetExceeded as exc:
+                ## already charged
+                done = 0
+                func = self.unwind(exc, base)
+                if func is None:
+                    raise
+            except Exception as exc:  ## pylint: disable=broad-except
+                ## charge the partial batch, or a loop that keeps
+                ## raising and trapping would run for free
+                done = batch - n
+                func = self.unwind(exc, base)
+                if func is None:
+                    raise
+
+    def budget_charge(self, steps):
+        ## charge steps bounces to every budget in force and return how
+        ## many to run before the next charge: BUDGET_BATCH, or fewer
+        ## to stop right after the one that exhausts a step budget.
+        ## raise BudgetExceeded for the outermost budget that ran out
+        n = BUDGET_BATCH
+        now = time.monotonic()
+        out = None
+        b = self.budget
+        while b is not None:
+            b.steps -= steps
+            if b.steps < 0:
+                out = b, "step budget"
+            elif now >= b.deadline:
+                out = b, "deadline"
+            elif b.steps < n:
+                n = b.steps + 1
+            b = b.up
+        if out is not None:
+            raise BudgetExceeded(*out)
+        return n
+
+    def trampoline_counted(self, func):
+        st = self.stats_
+        counts = st.counts
+        steps = 0
+        start = st.steps
+        t0 = time.perf_counter()
+        base = self.s
+        saved = self.run_begin()
+        failed = False
+        if self.budget is None:
+            ## unlimited, but vm_run bounces on every call under a
+            ## budget, so that its calls get counted too
+            self.budget = Budget(None, None, None)
+        st.depth += 1
+        try:
+            while True:
+                try:
+                    while func is not k_land:
+                        ## vm Labels are callable objects, count them by
+                        ## class
+                        name = getattr(func, "__qualname__", None)
+                        if name is None:
+                            name = func.__class__.__qualname__
+                        counts[name] = counts.get(name, 0) + 1
+                        steps += 1
+                        func = func(self)
+                    if self.budget is None or self.budget.resume is None:
+                        return self.val
+                    ## with-budget: the rest isn't counted
+                    return self.trampoline_budget(k_land, base)
+                except Exception as exc:  ## pylint: disable=broad-except
+                    func = self.unwind(exc, base)
+                    if func is None:
+                        raise
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.run_end(saved, failed)
+            st.steps += steps
+            st.depth -= 1
+            if not st.depth:
+                dt = time.perf_counter() - t0
+                steps = st.steps - start
+                st.runs += 1
+                st.time += dt
+                st.last = (steps, dt)
+                n = steps.bit_length()
+                st.hist[n] = st.hist.get(n, 0) + 1
+
+    async def atrampoline(self, func, steps=1000, timeslice=None):
+        ## pylint: disable=too-many-locals, too-many-nested-blocks
+        ## asyncio is loaded by whoever runs us; no need to pay for it
+        ## at startup
+        import asyncio  ## pylint: disable=import-outside-toplevel
+
+        land = k_land
+        wait = k_await
+        clock = time.perf_counter
+        last = clock()
+        base = self.s
+        n = steps
+        saved = self.run_begin()
+        failed = False
+        if self.budget is None:
+            ## unlimited, but vm_run bounces on every call under a
+            ## budget, so that code gets to yield every steps too
+            self.budget = Budget(None, None, None)
+        try:
+            while True:
+                try:
+                    while func is not land:
+                        if func is wait:
+                            self.exp = await self.exp
+                            func = k_py_value_to_lisp_value
+                            continue
+                        func = func(self)
+                        n -= 1
+                        if not n:
+                            n = steps
+                            if self.budget is not None:
+                                ## with-budget, charged every steps bounces
+                                self.budget_charge(steps)
+                            now = clock()
+                            if timeslice is None or now - last >= timeslice:
+                                await asyncio.sleep(0)
+                                last = clock()
+                    b = self.budget
+                    if b is None or b.resume is None:
+                        return self.val
+                    func, b.resume = b.resume, None
+                except Exception as exc:  ## pylint: disable=broad-except
+                    func = self.unwind(exc, base)
+                    if func is None:
+                        raise
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.run_end(saved, failed)
+
+    def unwind(self, exc, base):
+        ## pop ctx.s down to the innermost Trap pushed since this
+        ## trampoline started at stack base, hand it exc and return its
+        ## continuation. None if there is no such Trap. BudgetExceeded
+        ## goes past Traps to the frame of the Budget that ran out
+        budget = exc.budget if exc.__class__ is BudgetExceeded else None
+        s = self.s
+        found = popped = None
+        while s is not base:
+            if s is EL:
+                ## a continuation took us out from under base
+                return None
+            x, s = s
+            if found is not None:
+                continue
+            t = x.__class__
+            if t is Budget:
+                popped = x
+                if x is budget:
+                    found = x, s
+            elif t is Trap and budget is None:
+                found = x, s
+        if found is None:
+            return None
+        trap, s = found
+        self.env, s = s
+        self.cont, self.s = s
+        if popped is not None:
+            self.budget = popped.up
+        if budget is not None or not trap.raw:
+            exc = trap_message(exc)
+        self.val = [EL, [exc, EL]]
+        return self.cont
+
+    def instrument(self, on=True):
+        ## start counting afresh, or stop
+        self.stats_ = Stats() if on else None
+        self.trampoline = (
+            self.trampoline_counted if on else self.trampoline_plain
+        )
 
-    class Land(Exception):
-        pass
+    def stats(self):
+        ## what trampoline_counted has seen so far as a dict, None if
+        ## instrument() is off. counts is sorted by bounces, hist maps a
+        ## power of two to the number of runs with fewer steps than that
+        st = self.stats_
+        if st is None:
+            return None
+        return {
+            "runs": st.runs,
+            "steps": st.steps,
+            "time": st.time,
+            "last": st.last,
+            "counts": dict(
+                sorted(st.counts.items(), key=lambda kv: (-kv[1], kv[0]))
+            ),
+            "hist": {1 << n: k for n, k in sorted(st.hist.items())},
+        }
 
     ## unpack
 
@@ -355,21 +910,199 @@ class Context:
 ## {{{ continuation
 
 
+class Trap:
+    ## pylint: disable=too-few-public-methods
+    ## an error handler on ctx.s, with the env and cont to return to
+    ## under it. see Context.unwind(). raw means hand over the exception
+    ## itself rather than its message
+    __slots__ = ("raw",)
+
+    def __init__(self, raw=False):
+        self.raw = raw
+
+
+TRAP = Trap()
+TRAP_RAW = Trap(True)
+
+
+def push_trap(ctx, raw=False):
+    ## guard what runs next with a trap; continue to k_trap_done
+    ctx.s = [TRAP_RAW if raw else TRAP, [ctx.env, [ctx.cont, ctx.s]]]
+    ctx.cont = k_trap_done
+
+
+def k_trap_done(ctx):
+    ## no error: drop the trap, the value becomes (#t value)
+    _, s = ctx.s
+    ctx.env, s = s
+    ctx.cont, ctx.s = s
+    ctx.val = [T, [ctx.val, EL]]
+    return ctx.cont
+
+
+def trap_message(exc):
+    return f"{exc.__class__.__name__}: {exc}"
+
+
+class Budget:
+    ## pylint: disable=too-few-public-methods
+    ## limits for Context.trampoline_budget(): bounces left and a
+    ## time.monotonic() deadline, inf for none, and the budget in force
+    ## around this one. with-budget puts it on ctx.s as a frame like a
+    ## Trap's, see push_budget()
+    __slots__ = ("deadline", "resume", "steps", "up")
+
+    def __init__(self, steps, deadline, up):
+        self.steps = INF if steps is None else steps
+        self.deadline = INF if deadline is None else deadline
+        self.resume = None
+        self.up = up
+
+
+BUDGET_BATCH = 1000
+INF = float("inf")
+
+
+def push_budget(ctx, proc, steps=None, seconds=None):
+    ## call proc with no args under a budget, continue to
+    ## k_budget_done. this lands so that whichever trampoline is
+    ## running hands over to Context.trampoline_budget()
+    deadline = None if seconds is None else time.monotonic() + seconds
+    b = Budget(steps, deadline, ctx.budget)
+    ctx.s = [b, [ctx.env, [ctx.cont, ctx.s]]]
+    ctx.cont = k_budget_done
+    ctx.argl = EL
+    if proc.ffi:
+        ctx.exp = proc
+        proc = k_ffi
+    b.resume = proc
+    ctx.budget = b
+    return k_land
+
+
+def k_budget_done(ctx):
+    ## proc returned in time: drop the budget, the value becomes
+    ## (#t value)
+    b, s = ctx.s
+    ctx.env, s = s
+    ctx.cont, ctx.s = s
+    ctx.budget = b.up
+    ctx.val = [T, [ctx.val, EL]]
+    return ctx.cont
+
+
+def k_land(ctx):  ## pylint: disable=unused-argument
+    ## what leval and friends continue to when done. the trampoline
+    ## stops when it comes up, so this only runs if called directly
+    return k_land
+
+
+def budget_base(b):
+    ## the unlimited Budget that atrampoline or trampoline_counted put
+    ## at the bottom of chain b, None if there is none
+    while b is not None:
+        if b.up is None:
+            return b if b.steps == INF and b.deadline == INF else None
+        b = b.up
+    return None
+
+
 def create_continuation(ctx):
     s = ctx.save()
+    budget = ctx.budget
 
     def continuation(ctx):
         x = ctx.unpack1()
         ctx.restore(s)
         ctx.val = x
-        return ctx.cont
-
-    continuation.special = continuation.ffi = False
+        if budget is ctx.budget:
+            return ctx.cont
+        if budget is None or budget_base(budget) is budget:
+            ## made without limits, keep this run's own
+            ctx.budget = budget_base(ctx.budget)
+            return ctx.cont
+        ## back under the budgets in force when it was made: land so
+        ## that the trampoline enforces them, see push_budget()
+        ctx.budget = budget
+        budget.resume = ctx.cont
+        return k_land
+
+    continuation.special = continuation.ffi = continuation.leaf = False
     continuation.continuation = True
 
     return continuation
 
 
+## }}}
+## {{{ green threads
+
+## a task is the registers of a suspended computation as returned by
+## ctx.save(), including its stack. ctx.tasks is the run queue; to
+## resume a task, restore its registers and continue to ctx.cont. so a
+## task switch costs the same as invoking a continuation. the run
+## queue outlives the leval that filled it, so (spawn ...) and
+## (run-all) may come in separate top level forms; run_end() has the
+## details
+
+
+def task_queue(ctx):
+    ## the run queue, made on first use
+    tasks = ctx.tasks
+    if tasks is None:
+        tasks = ctx.tasks = collections.deque()
+    return tasks
+
+
+def task_new(ctx, proc):
+    ## registers for a task that will call proc with no args on a
+    ## stack of its own
+    return EL, k_task_start, ctx.g, proc, EL, EL
+
+
+def task_switch(ctx):
+    ## park the current task at the back of the run queue. its value
+    ## when it resumes is ctx.val
+    tasks = ctx.tasks
+    if not tasks:
+        return ctx.cont
+    tasks.append(ctx.save())
+    return k_task_next
+
+
+def task_wake(ctx, task, val):
+    ## put a blocked task on the run queue to resume with value val
+    argl, cont, env, exp, _, s = task
+    ctx.tasks.append((argl, cont, env, exp, val, s))
+
+
+def k_task_next(ctx):
+    ## the current task is finished or blocked: resume the next one
+    tasks = ctx.tasks
+    if not tasks:
+        raise RuntimeError("deadlock: all tasks are blocked")
+    ctx.restore(tasks.popleft())
+    return ctx.cont
+
+
+def k_task_run_all(ctx):
+    ## let everything else run until the run queue is empty
+    if ctx.tasks:
+        ctx.tasks.append(ctx.save())
+        return k_task_next
+    ctx.cont = ctx.pop()
+    ctx.val = EL
+    return ctx.cont
+
+
+def k_task_start(ctx):
+    proc = ctx.exp
+    ctx.argl = EL
+    ctx.cont = k_task_next
+    if proc.ffi:
+        return k_ffi
+    return proc
+
+
 ## }}}
 ## {{{ lambda
 
@@ -381,8 +1114,9 @@ def create_lambda(params, body, env):
         ctx.exp = body
         return k_leval
 
-    lcall.special = lcall.ffi = False
+    lcall.special = lcall.ffi = lcall.leaf = False
     lcall.lambda_ = params, body
+    lcall.env = env
 
     return lcall
 
@@ -472,6 +1206,22 @@ def k_stringify_last(ctx):
 ## {{{ leval
 
 
+def global_miss(g, sym):
+    ## sym isn't in the global env g: look it up in the base envs below g
+    ## and copy it into g so that the next lookup stops there instead of
+    ## missing again. a base never changes, so the copy can't go stale
+    ## and g.ver needn't move
+    e = g[SENTINEL]
+    while e is not SENTINEL:
+        v = e.get(sym, SENTINEL)
+        if v is not SENTINEL:
+            if not g.frozen:
+                dict.__setitem__(g, sym, v)
+            return v
+        e = e[SENTINEL]
+    raise NameError(str(sym))
+
+
 def k_leval(ctx):
     ## pylint: disable=too-many-branches
     x = ctx.exp
@@ -483,6 +1233,9 @@ def k_leval(ctx):
                 ctx.val = e[x]
                 return ctx.cont
             except KeyError:
+                if e.__class__ is Globals:
+                    ctx.val = global_miss(e, x)
+                    return ctx.cont
                 e = e[SENTINEL]
         raise NameError(str(x))
 
@@ -498,6 +1251,9 @@ def k_leval(ctx):
                 op = e[op]
                 break
             except KeyError:
+                if e.__class__ is Globals:
+                    op = global_miss(e, op)
+                    break
                 e = e[SENTINEL]
         else:
             raise NameError(str(op))
@@ -582,6 +1338,1441 @@ def k_leval_last(ctx):
     return proc
 
 
+## }}}
+## {{{ frames
+##
+## the compiled engine resolves each local variable to a (depth, slot)
+## address when a lambda is compiled, and its environments are Frames:
+## a slot list plus a pointer to the enclosing env. slots for internal
+## defines start out as SENTINEL, meaning "not defined yet".
+##
+## the dict-style methods let k_leval, eval, set! and friends treat a
+## Frame like any other environment. names that turn up at run time,
+## e.g. via (eval (define ...)), go in the overflow dict x.
+
+
+class Frame:
+    __slots__ = ("v", "up", "names", "x")
+
+    def __init__(self, v, up, names):
+        self.v = v
+        self.up = up
+        self.names = names
+        self.x = None
+
+    def __getitem__(self, sym):
+        if sym is SENTINEL:
+            return self.up
+        i = self.names.get(sym)
+        if i is not None:
+            v = self.v[i]
+            if v is not SENTINEL:
+                return v
+        elif self.x is not None:
+            return self.x[sym]
+        raise KeyError(sym)
+
+    def __setitem__(self, sym, value):
+        i = self.names.get(sym)
+        if i is not None:
+            self.v[i] = value
+            return
+        if self.x is None:
+            self.x = {}
+        elif sym in self.x:
+            self.x[sym] = value
+            return
+        self.x[sym] = value
+        ## a new name here may shadow a global that compiled code cached.
+        ## that code caches against the nearest global env, a context's
+        ## own, so a base env further up is left alone
+        e = self.up
+        while e is not SENTINEL:
+            if e.__class__ is Globals:
+                e.shadowed.add(sym)
+                e.ver += 1
+                return
+            e = e[SENTINEL]
+
+    def __contains__(self, sym):
+        i = self.names.get(sym)
+        if i is not None:
+            return self.v[i] is not SENTINEL
+        return self.x is not None and sym in self.x
+
+
+def env_lookup(e, sym):
+    ## dynamic lookup through any mix of Frames and dicts
+    while e is not SENTINEL:
+        if e.__class__ is Frame:
+            i = e.names.get(sym)
+            if i is not None and e.v[i] is not SENTINEL:
+                return e.v[i]
+            x = e.x
+            if x is not None and sym in x:
+                return x[sym]
+            e = e.up
+        else:
+            try:
+                return e[sym]
+            except KeyError:
+                e = e[SENTINEL]
+    raise NameError(str(sym))
+
+
+def env_assign(e, sym, value):
+    ## dynamic set!. a binding in a frozen base env is copied on write
+    ## to the global env layered on it.
+    g = None
+    while e is not SENTINEL:
+        if sym in e:
+            if e.__class__ is Globals and e.frozen:
+                if g is None:
+                    raise TypeError(f"cannot set {sym} in a frozen env")
+                e = g
+            e[sym] = value
+            return
+        if e.__class__ is Globals:
+            g = e
+        e = e[SENTINEL]
+    raise NameError(str(sym))
+
+
+## }}}
+## {{{ closure compiler
+##
+## the "compiled" engine analyzes a lambda body once, when the lambda is
+## created, and turns it into a tree of closures. each closure is a node
+## that behaves exactly like k_leval specialized for one expression: it
+## reads ctx.env, sets ctx.val, and returns the next continuation. so
+## everything stays cps and trampolined and call/cc and tco still work.
+##
+## compile_expr() returns a (node, direct) pair. direct is None or a
+## function f(ctx) -> value for expressions that can be computed without
+## going through the trampoline (constants, variables, quote, lambda, and
+## anything built solely from those). the application nodes use direct
+## to evaluate arguments inline instead of pushing a frame per argument.
+##
+## a call like (car x) with simple args can't be direct since car might
+## be rebound to a lambda. its node gets an .attempt function instead:
+## if the operator turns out to be a @leaf primitive it is called right
+## there and its value returned, otherwise attempt returns SENTINEL
+## without having evaluated anything and the caller runs the node.
+##
+## when a node pushes a frame and sets ctx.cont = k before running a
+## subexpression, it checks whether k came straight back and if so calls
+## it inline to skip a trip through the trampoline. that's equivalent to
+## returning k, and the nesting is bounded by the size of the expression.
+##
+## special forms are recognized at compile time via the .compile hook
+## that lisp.py attaches with @cmpl; other special forms known at compile
+## time are handed to k_leval as-is. anything else compiles to an
+## application node that checks .special at run time (the operator may
+## not be defined yet) and hands over the raw args if need be. the other
+## way around isn't checked: a lambda compiled before, e.g., (define (if
+## & args) ...) keeps the special form, where k_leval would call the new
+## binding. checking each time would cost every if, and, etc. a lookup.
+
+
+class Scope:
+    ## compile-time mirror of a Frame: names maps symbols to slots. the
+    ## root scope has names=None and env is the run time environment the
+    ## outermost compiled lambda closes over.
+
+    __slots__ = ("names", "up", "env")
+
+    def __init__(self, names, up, env):
+        self.names = names
+        self.up = up
+        self.env = env
+
+    def resolve(self, sym):
+        ## (depth, slot) of a local variable or None
+        d, s = 0, self
+        while s.names is not None:
+            i = s.names.get(sym)
+            if i is not None:
+                return d, i
+            d += 1
+            s = s.up
+        return None
+
+    def lookup(self, sym):
+        ## compile-time binding of a special form name or None
+        if self.resolve(sym) is not None:
+            return None
+        try:
+            return env_lookup(self.env, sym)
+        except NameError:
+            return None
+
+
+def frame_scope(env):
+    ## rebuild the scopes for a lambda created at run time inside a Frame
+    frames = []
+    while env.__class__ is Frame:
+        frames.append(env)
+        env = env.up
+    scope = Scope(None, None, env)
+    for f in reversed(frames):
+        scope = Scope(f.names, scope, env)
+    return scope
+
+
+def scan_defines(ctx, body, names):
+    ## give a slot to each name bound by define and special in a body
+    d, s = ctx.symbol("define"), ctx.symbol("special")
+    l, q = ctx.symbol("lambda"), ctx.symbol("quote")
+    qq = ctx.symbol("quasiquote")
+    todo = [body]
+    while todo:
+        x = todo.pop()
+        if x.__class__ is not list:
+            continue
+        op = x[0]
+        if op is l or op is q or op is qq:
+            continue
+        if (op is d or op is s) and x[1].__class__ is list:
+            sym = x[1][0]
+            if sym.__class__ is list:
+                sym = sym[0]
+                x = EL
+            else:
+                x = x[1][1]
+            if sym.__class__ is Symbol and sym not in names:
+                names[sym] = len(names)
+        while x.__class__ is list:
+            todo.append(x[0])
+            x = x[1]
+    return names
+
+
+def compile_expr(ctx, x, scope):
+    t = x.__class__
+    if t is Symbol:
+        return compile_symbol(x, scope)
+    if t is not list:
+        return compile_constant(x)
+    op, args = x
+    try:
+        if op.__class__ is Symbol:
+            spec = scope.lookup(op)
+            if getattr(spec, "special", False):
+                hook = getattr(spec, "compile", None)
+                if hook is None:
+                    return compile_interp(x)
+                return hook(ctx, args, scope)
+        return compile_application(ctx, op, args, scope)
+    except SyntaxError:
+        ## let k_leval report it if and when x is actually evaluated
+        return compile_interp(x)
+
+
+def compile_interp(x):
+    ## fall back to the interpreter, e.g., for (quasiquote) or (special)
+    def node(ctx):
+        ctx.exp = x
+        return k_leval
+
+    return node, None
+
+
+def compile_direct(direct):
+    def node(ctx):
+        ctx.val = direct(ctx)
+        return ctx.cont
+
+    return node, direct
+
+
+def compile_constant(x):
+    def node(ctx):
+        ctx.val = x
+        return ctx.cont
+
+    def direct(_):
+        return x
+
+    return node, direct
+
+
+def compile_symbol(sym, scope):
+    addr = scope.resolve(sym)
+    g = scope.env
+    if addr is None and g.__class__ is Globals:
+        ## inline cache. between here and g there are only Frames of the
+        ## enclosing scopes and sym isn't one of their names, so sym must
+        ## come from g unless it shows up in an overflow dict, which
+        ## bumps g.ver and marks sym as shadowed for good.
+        ver, val = -1, None
+
+        def direct(ctx):
+            nonlocal ver, val
+            if ver == g.ver:
+                return val
+            v = env_lookup(ctx.env, sym)
+            if sym not in g.shadowed:
+                ver, val = g.ver, v
+            return v
+
+    elif addr is None:
+
+        def direct(ctx):
+            return env_lookup(ctx.env, sym)
+
+    elif addr[0] == 0:
+        i = addr[1]
+
+        def direct(ctx):
+            e = ctx.env
+            v = e.v[i]
+            if v is SENTINEL:
+                ## not defined yet, see what the enclosing envs say
+                return env_lookup(e.up, sym)
+            return v
+
+    elif addr[0] == 1:
+        i = addr[1]
+
+        def direct(ctx):
+            e = ctx.env.up
+            v = e.v[i]
+            if v is SENTINEL:
+                return env_lookup(e.up, sym)
+            return v
+
+    else:
+        d, i = addr
+
+        def direct(ctx):
+            e = ctx.env
+            for _ in range(d):
+                e = e.up
+            v = e.v[i]
+            if v is SENTINEL:
+                return env_lookup(e.up, sym)
+            return v
+
+    return compile_direct(direct)
+
+
+def compile_define(sym, scope):
+    ## define(ctx, value) binds sym in the current frame
+    i = scope.names.get(sym) if scope.names is not None else None
+    if i is None:
+
+        def define(ctx, value):
+            if ctx.prof is not None:
+                value = ctx.prof.wrap(sym, value)
+            ctx.env[sym] = value
+
+    else:
+
+        def define(ctx, value):
+            if ctx.prof is not None:
+                value = ctx.prof.wrap(sym, value)
+            ctx.env.v[i] = value
+
+    return define
+
+
+def compile_assign(sym, scope):
+    ## assign(ctx, value) implements set!
+    addr = scope.resolve(sym)
+    if addr is None:
+
+        def assign(ctx, value):
+            env_assign(ctx.env, sym, value)
+
+    else:
+        d, i = addr
+
+        def assign(ctx, value):
+            e = ctx.env
+            for _ in range(d):
+                e = e.up
+            if e.v[i] is SENTINEL:
+                env_assign(e.up, sym, value)
+            else:
+                e.v[i] = value
+
+    return assign
+
+
+def compile_attempt(nd):
+    ## fallible inline evaluator for a compiled expr or None
+    node, direct = nd
+    return direct or getattr(node, "attempt", None)
+
+
+def compile_sequence(ctx, items, scope):
+    ## compile a python list of expressions like (begin ...)
+    if not items:
+        return compile_constant(EL)
+    rest = compile_expr(ctx, items[-1], scope)
+    for x in reversed(items[:-1]):
+        rest = compile_seq2(compile_expr(ctx, x, scope), rest)
+    return rest
+
+
+def compile_seq2(first, rest):
+    fn, fd = first
+    rn, rd = rest
+    if fd is not None:
+
+        def node(ctx):
+            fd(ctx)
+            return rn(ctx)
+
+        if rd is None:
+            return node, None
+
+        def direct(ctx):
+            fd(ctx)
+            return rd(ctx)
+
+        return node, direct
+
+    fa = compile_attempt(first)
+
+    def k_seq(ctx):
+        ctx.env, s = ctx.s
+        ctx.cont, ctx.s = s
+        return rn(ctx)
+
+    def node(ctx):  ## pylint: disable=function-redefined
+        if fa is not None and fa(ctx) is not SENTINEL:
+            return rn(ctx)
+        ctx.s = [ctx.env, [ctx.cont, ctx.s]]
+        ctx.cont = k_seq
+        r = fn(ctx)
+        return k_seq(ctx) if r is k_seq else r
+
+    return node, None
+
+
+## }}}
+## {{{ application
+
+
+def compile_application(ctx, op, args, scope):
+    opn, opd = compile_expr(ctx, op, scope)
+    argcs = []
+    a = args
+    while a is not EL:
+        if a.__class__ is not list:
+            raise SyntaxError(f"expected list, got {a!r}")
+        x, a = a
+        argcs.append(compile_expr(ctx, x, scope))
+    steps = compile_call_steps(argcs)
+    attempts = tuple(compile_attempt(argc) for argc in argcs)
+
+    if opd is not None and None not in attempts and len(attempts) < 4:
+        node = compile_app_fast(opd, args, attempts, steps)
+        directs = tuple(d for _, d in argcs)
+        if None not in directs:
+            node.attempt = compile_app_attempt(opd, directs)
+        return node, None
+
+    def call(ctx, proc):
+        try:
+            if proc.special:
+                ctx.argl = args
+                return proc
+        except AttributeError:
+            raise SyntaxError(f"expected callable, got {proc!r}") from None
+        return steps[0](ctx, proc, ())
+
+    if opd is not None:
+
+        def node(ctx):  ## pylint: disable=function-redefined
+            return call(ctx, opd(ctx))
+
+        return node, None
+
+    def k_app_op(ctx):
+        ctx.env, s = ctx.s
+        ctx.cont, ctx.s = s
+        return call(ctx, ctx.val)
+
+    def node(ctx):  ## pylint: disable=function-redefined
+        ctx.s = [ctx.env, [ctx.cont, ctx.s]]
+        ctx.cont = k_app_op
+        r = opn(ctx)
+        return k_app_op(ctx) if r is k_app_op else r
+
+    return node, None
+
+
+def compile_app_fast(opd, args, attempts, steps):
+    ## pylint: disable=too-many-statements
+    ## the common case: a known operator and up to 3 simple args. the
+    ## proc is called directly; it is bounded work that returns the next
+    ## continuation, so this can't recurse without limit. if an arg can't
+    ## be evaluated inline, continue with the general steps from there.
+    n = len(attempts)
+    if n == 0:
+
+        def node(ctx):
+            proc = opd(ctx)
+            try:
+                if proc.special:
+                    ctx.argl = args
+                    return proc
+            except AttributeError:
+                raise SyntaxError(f"expected callable, got {proc!r}") from None
+            ctx.argl = EL
+            if proc.ffi:
+                ctx.exp = proc
+                return k_ffi
+            return proc(ctx)
+
+    elif n == 1:
+        (a0,) = attempts
+
+        def node(ctx):
+            proc = opd(ctx)
+            try:
+                if proc.special:
+                    ctx.argl = args
+                    return proc
+            except AttributeError:
+                raise SyntaxError(f"expected callable, got {proc!r}") from None
+            x = a0(ctx)
+            if x is SENTINEL:
+                return steps[0](ctx, proc, ())
+            ctx.argl = [x, EL]
+            if proc.ffi:
+                ctx.exp = proc
+                return k_ffi
+            return proc(ctx)
+
+    elif n == 2:
+        a0, a1 = attempts
+
+        def node(ctx):
+            proc = opd(ctx)
+            try:
+                if proc.special:
+                    ctx.argl = args
+                    return proc
+            except AttributeError:
+                raise SyntaxError(f"expected callable, got {proc!r}") from None
+            x = a0(ctx)
+            if x is SENTINEL:
+                return steps[0](ctx, proc, ())
+            y = a1(ctx)
+            if y is SENTINEL:
+                return steps[1](ctx, proc, (x,))
+            ctx.argl = [x, [y, EL]]
+            if proc.ffi:
+                ctx.exp = proc
+                return k_ffi
+            return proc(ctx)
+
+    else:
+        a0, a1, a2 = attempts
+
+        def node(ctx):
+            proc = opd(ctx)
+            try:
+                if proc.special:
+                    ctx.argl = args
+                    return proc
+            except AttributeError:
+                raise SyntaxError(f"expected callable, got {proc!r}") from None
+            x = a0(ctx)
+            if x is SENTINEL:
+                return steps[0](ctx, proc, ())
+            y = a1(ctx)
+            if y is SENTINEL:
+                return steps[1](ctx, proc, (x,))
+            z = a2(ctx)
+            if z is SENTINEL:
+                return steps[2](ctx, proc, (x, y))
+            ctx.argl = [x, [y, [z, EL]]]
+            if proc.ffi:
+                ctx.exp = proc
+                return k_ffi
+            return proc(ctx)
+
+    return node
+
+
+def compile_app_attempt(opd, directs):
+    ## evaluate a call to a leaf primitive inline or return SENTINEL
+    n = len(directs)
+    if n == 1:
+        (d0,) = directs
+
+        def attempt(ctx):
+            proc = opd(ctx)
+            try:
+                if not proc.leaf:
+                    return SENTINEL
+            except AttributeError:
+                return SENTINEL
+            ctx.argl = [d0(ctx), EL]
+            proc(ctx)
+            return ctx.val
+
+    elif n == 2:
+        d0, d1 = directs
+
+        def attempt(ctx):
+            proc = opd(ctx)
+            try:
+                if not proc.leaf:
+                    return SENTINEL
+            except AttributeError:
+                return SENTINEL
+            x = d0(ctx)
+            ctx.argl = [x, [d1(ctx), EL]]
+            proc(ctx)
+            return ctx.val
+
+    else:
+
+        def attempt(ctx):
+            proc = opd(ctx)
+            try:
+                if not proc.leaf:
+                    return SENTINEL
+            except AttributeError:
+                return SENTINEL
+            argl = EL
+            for x in reversed([d(ctx) for d in directs]):
+                argl = [x, argl]
+            ctx.argl = argl
+            proc(ctx)
+            return ctx.val
+
+    return attempt
+
+
+def compile_call_steps(argcs, finish=None):
+    ## steps[i](ctx, proc, acc) evaluates args i... left to right, then
+    ## calls finish(ctx, proc, acc), by default calling proc. acc is a
+    ## tuple of the values so far so a continuation captured while
+    ## evaluating an arg can be re-entered any number of times.
+    if finish is None:
+        finish = compile_call_finish
+
+    steps = [finish]
+    for argc in reversed(argcs):
+        steps.insert(0, compile_call_step(argc, steps[0]))
+    return steps
+
+
+def compile_call_finish(ctx, proc, acc):
+    argl = EL
+    for x in reversed(acc):
+        argl = [x, argl]
+    ctx.argl = argl
+    if proc.ffi:
+        ctx.exp = proc
+        return k_ffi
+    return proc(ctx)
+
+
+def compile_call_step(argc, nxt):
+    node, direct = argc
+    if direct is not None:
+
+        def step(ctx, proc, acc):
+            return nxt(ctx, proc, acc + (direct(ctx),))
+
+        return step
+
+    attempt = getattr(node, "attempt", None)
+
+    def k_call_arg(ctx):
+        acc, s = ctx.s
+        proc, s = s
+        ctx.env, s = s
+        ctx.cont, ctx.s = s
+        return nxt(ctx, proc, acc + (ctx.val,))
+
+    def step(ctx, proc, acc):  ## pylint: disable=function-redefined
+        if attempt is not None:
+            x = attempt(ctx)
+            if x is not SENTINEL:
+                return nxt(ctx, proc, acc + (x,))
+        ctx.s = [acc, [proc, [ctx.env, [ctx.cont, ctx.s]]]]
+        ctx.cont = k_call_arg
+        r = node(ctx)
+        return k_call_arg(ctx) if r is k_call_arg else r
+
+    return step
+
+
+## }}}
+## {{{ compiled lambda
+
+
+def compile_params(ctx, params):
+    fixed = []
+    v = ctx.symbol("&")
+    p = params
+    while p is not EL:
+        if p.__class__ is not list:
+            raise SyntaxError(f"expected list, got {p!r}")
+        x, p = p
+        if x.__class__ is not Symbol:
+            raise SyntaxError(f"expected symbol, got {x!r}")
+        if x is v:
+            if p is EL:
+                raise SyntaxError("params end with &")
+            if p.__class__ is not list or p[1] is not EL:
+                raise SyntaxError("trailing junk after &")
+            return tuple(fixed), symcheck(p[0])
+        fixed.append(x)
+    return tuple(fixed), None
+
+
+def compile_lambda(ctx, params, body, scope):
+    ## pylint: disable=no-member, too-many-statements
+    ## compile a lambda body in a new scope. returns make(env) which
+    ## creates the closure cheaply each time the lambda is evaluated.
+    fixed, rest = compile_params(ctx, params)
+    names = {}
+    for p in fixed:
+        names[p] = len(names)
+    if rest is not None:
+        names[rest] = len(names)
+    nargs = len(names)
+    scan_defines(ctx, body, names)
+    pad = [SENTINEL] * (len(names) - nargs)
+    code = compile_expr(ctx, body, Scope(names, scope, scope.env))[0]
+
+    ## a special form runs in its caller's env which doesn't match the
+    ## compile-time scopes, so it gets a dict env and the interpreter
+    def special(ctx):
+        ctx.env = create_environment(ctx, params, ctx.argl, ctx.env)
+        ctx.exp = body
+        return k_leval
+
+    if rest is None and len(fixed) == 0:
+
+        def make(env):
+            def lcall(ctx):
+                if lcall.special:
+                    return special(ctx)
+                if ctx.argl is not EL:
+                    raise SyntaxError("too many args")
+                ctx.env = Frame(pad[:], env, names)
+                return code
+
+            return finish_closure(lcall, params, body, env)
+
+    elif rest is None and len(fixed) == 1:
+
+        def make(env):
+            def lcall(ctx):
+                if lcall.special:
+                    return special(ctx)
+                try:
+                    x, a = ctx.argl
+                except TypeError:
+                    raise SyntaxError("not enough args") from None
+                if a is not EL:
+                    raise SyntaxError("too many args")
+                ctx.env = Frame([x, *pad], env, names)
+                return code
+
+            return finish_closure(lcall, params, body, env)
+
+    elif rest is None and len(fixed) == 2:
+
+        def make(env):
+            def lcall(ctx):
+                if lcall.special:
+                    return special(ctx)
+                try:
+                    x, a = ctx.argl
+                    y, a = a
+                except TypeError:
+                    raise SyntaxError("not enough args") from None
+                if a is not EL:
+                    raise SyntaxError("too many args")
+                ctx.env = Frame([x, y, *pad], env, names)
+                return code
+
+            return finish_closure(lcall, params, body, env)
+
+    else:
+        n = len(fixed)
+
+        def make(env):
+            def lcall(ctx):
+                if lcall.special:
+                    return special(ctx)
+                v = []
+                a = ctx.argl
+                try:
+                    for _ in range(n):
+                        x, a = a
+                        v.append(x)
+                except TypeError:
+                    raise SyntaxError("not enough args") from None
+                if rest is not None:
+                    v.append(a)
+                elif a is not EL:
+                    raise SyntaxError("too many args")
+                ctx.env = Frame(v + pad, env, names)
+                return code
+
+            return finish_closure(lcall, params, body, env)
+
+    return make
+
+
+def finish_closure(lcall, params, body, env):
+    lcall.special = lcall.ffi = lcall.leaf = False
+    lcall.lambda_ = params, body
+    lcall.env = env
+    return lcall
+
+
+def create_compiled_lambda(ctx, params, body, env):
+    return compile_lambda(ctx, params, body, frame_scope(env))(env)
+
+
+## }}}
+## {{{ register machine
+##
+## the "vm" engine is sicp chapter 5.5: a lambda body is compiled once,
+## when the lambda is created, into a flat list of register machine
+## instructions and vm_run() executes them in a single python loop. the
+## registers are sicp's val, env, proc, argl and cont; the loop keeps
+## them in locals and writes them back to ctx whenever control leaves
+## it. the stack is ctx.s, same as everywhere else, so call/cc works.
+##
+## a Label marks a position in a code list. labels double as callable
+## continuations: when the vm calls a proc, ctx.cont is the Label to
+## return to, and the trampoline resumes the loop there by calling it.
+## if the call itself hands back a Label -- the entry point of a vm
+## lambda, or ctx.cont from a leaf primitive -- the loop just carries on
+## so vm code calling vm code never bounces through the trampoline.
+## anything else, e.g. k_leval from an interpreted lambda, goes back to
+## the trampoline.
+##
+## the compiler is sicp's: instruction sequences carry the registers
+## they need and modify, and vm_preserving() wraps save/restore around
+## a sequence only if a later one needs a register it clobbers. the
+## departures from the book: args are evaluated left to right onto a
+## reversed argl, (test) and (branch) are fused into BRANCH, and since
+## an operator may turn out to be a special form at run time, CHECK
+## looks at .special before the args are evaluated and if need be
+## hands the proc the raw args and jumps straight to the CALL. a special
+## form known at compile time stays compiled in even if its name is
+## rebound later, as in the closure compiler.
+
+(
+    VM_VAL_LOOKUP,
+    VM_VAL_CONST,
+    VM_PROC_LOOKUP,
+    VM_ARGS,
+    VM_CHECK,
+    VM_CALL,
+    VM_BRANCH,
+    VM_RETURN,
+    VM_SAVE_ENV,
+    VM_RESTORE_ENV,
+    VM_SAVE_CONT,
+    VM_RESTORE_CONT,
+    VM_ARGL_PUSH,
+    VM_ARGL_DONE,
+    VM_SAVE_PROC,
+    VM_RESTORE_PROC,
+    VM_SAVE_ARGL,
+    VM_RESTORE_ARGL,
+    VM_GOTO,
+    VM_PROC_VAL,
+    VM_PROC_CONST,
+    VM_LAMBDA,
+    VM_DEFINE,
+    VM_SET,
+    VM_BIND,
+    VM_EXTEND,
+    VM_INTERP,
+) = range(27)
+
+VM_SAVE = {
+    "argl": VM_SAVE_ARGL,
+    "cont": VM_SAVE_CONT,
+    "env": VM_SAVE_ENV,
+    "proc": VM_SAVE_PROC,
+}
+
+VM_RESTORE = {
+    "argl": VM_RESTORE_ARGL,
+    "cont": VM_RESTORE_CONT,
+    "env": VM_RESTORE_ENV,
+    "proc": VM_RESTORE_PROC,
+}
+
+VM_ALL = frozenset(("argl", "cont", "env", "proc", "val"))
+
+
+class Label:
+    ## pylint: disable=too-few-public-methods
+    ## a position in a code list and a continuation that resumes there
+    __slots__ = ("code", "pc")
+
+    def __init__(self):
+        self.code = self.pc = None
+
+    def __call__(self, ctx):
+        return vm_run(ctx, self.code, self.pc)
+
+
+class ISeq:
+    ## pylint: disable=too-few-public-methods
+    __slots__ = ("needs", "modifies", "code")
+
+    def __init__(self, needs, modifies, code):
+        self.needs = frozenset(needs)
+        self.modifies = frozenset(modifies)
+        self.code = code
+
+
+def vm_seq(needs, modifies, *code):
+    return ISeq(needs, modifies, list(code))
+
+
+def vm_append(*seqs):
+    needs, modifies, code = set(), set(), []
+    for q in seqs:
+        needs |= q.needs - modifies
+        modifies |= q.modifies
+        code.extend(q.code)
+    return ISeq(needs, modifies, code)
+
+
+def vm_preserving(regs, s1, s2):
+    for r in regs:
+        if r in s1.modifies and r in s2.needs:
+            s1 = ISeq(
+                s1.needs | {r},
+                s1.modifies - {r},
+                [(VM_SAVE[r],)] + s1.code + [(VM_RESTORE[r],)],
+            )
+    return vm_append(s1, s2)
+
+
+def vm_parallel(s1, s2):
+    return ISeq(
+        s1.needs | s2.needs, s1.modifies | s2.modifies, s1.code + s2.code
+    )
+
+
+def vm_linkage(linkage, seq):
+    ## linkage is "next", "return", or a Label to go to
+    if linkage == "next":
+        return seq
+    if linkage == "return":
+        return vm_preserving(
+            ("cont",), seq, vm_seq(("cont",), (), (VM_RETURN,))
+        )
+    return vm_append(seq, vm_seq((), (), (VM_GOTO, linkage)))
+
+
+def vm_compile(ctx, x, target, linkage, scope):
+    ## pylint: disable=too-many-return-statements
+    ## compile x so its value ends up in target, "val" or "proc"
+    t = x.__class__
+    if t is Symbol:
+        op = VM_PROC_LOOKUP if target == "proc" else VM_VAL_LOOKUP
+        return vm_linkage(linkage, vm_seq(("env",), (target,), (op, x)))
+    if t is not list:
+        op = VM_PROC_CONST if target == "proc" else VM_VAL_CONST
+        return vm_linkage(linkage, vm_seq((), (target,), (op, x)))
+    if target == "proc":
+        return vm_linkage(
+            linkage,
+            vm_append(
+                vm_compile(ctx, x, "val", "next", scope),
+                vm_seq(("val",), ("proc",), (VM_PROC_VAL,)),
+            ),
+        )
+    op, args = x
+    try:
+        if op.__class__ is Symbol:
+            spec = scope.lookup(op)
+            if getattr(spec, "special", False):
+                hook = getattr(spec, "vmcompile", None)
+                if hook is None:
+                    return vm_compile_interp(x, linkage)
+                return hook(ctx, args, scope, linkage)
+        return vm_compile_application(ctx, op, args, scope, linkage)
+    except SyntaxError:
+        ## let k_leval report it if and when x is actually evaluated
+        return vm_compile_interp(x, linkage)
+
+
+def vm_compile_interp(x, linkage):
+    ## hand x to k_leval, e.g., for (quasiquote) or (special)
+    if linkage == "return":
+        return vm_seq(("env", "cont"), VM_ALL, (VM_INTERP, x, None))
+    ret = Label()
+    seq = vm_seq(("env",), VM_ALL, (VM_INTERP, x, ret), ret)
+    return vm_linkage(linkage, seq)
+
+
+def vm_compile_constant(x, linkage):
+    return vm_linkage(linkage, vm_seq((), ("val",), (VM_VAL_CONST, x)))
+
+
+def vm_compile_sequence(ctx, items, scope, linkage):
+    ## compile a python list of expressions like (begin ...)
+    if not items:
+        return vm_compile_constant(EL, linkage)
+    ret = vm_compile(ctx, items[-1], "val", linkage, scope)
+    for x in reversed(items[:-1]):
+        ret = vm_preserving(
+            ("env", "cont"), vm_compile(ctx, x, "val", "next", scope), ret
+        )
+    return ret
+
+
+def vm_compile_if(test, conseq, alt, linkage):
+    ## test is a sequence leaving its value in val, conseq and alt are
+    ## functions of a linkage that return a sequence
+    f = Label()
+    if linkage == "next":
+        after = Label()
+        c = conseq(after)
+        a = vm_append(alt("next"), vm_seq((), (), after))
+    else:
+        c = conseq(linkage)
+        a = alt(linkage)
+    return vm_preserving(
+        ("env", "cont"),
+        test,
+        vm_append(
+            vm_seq(("val",), (), (VM_BRANCH, f)),
+            vm_parallel(c, vm_append(vm_seq((), (), f), a)),
+        ),
+    )
+
+
+def vm_compile_define(sym, value, linkage):
+    ## value is a sequence leaving its value in val
+    return vm_linkage(
+        linkage,
+        vm_preserving(
+            ("env",), value, vm_seq(("env", "val"), ("val",), (VM_DEFINE, sym))
+        ),
+    )
+
+
+def vm_compile_assign(sym, value, linkage):
+    return vm_linkage(
+        linkage,
+        vm_preserving(
+            ("env",), value, vm_seq(("env", "val"), ("val",), (VM_SET, sym))
+        ),
+    )
+
+
+def vm_compile_closure(make, linkage):
+    ## make(env) is from vm_compile_lambda()
+    return vm_linkage(linkage, vm_seq(("env",), ("val",), (VM_LAMBDA, make)))
+
+
+def vm_compile_args(ctx, exprs, scope):
+    ## leave the values of exprs in argl
+    if all(x.__class__ is not list for x in exprs):
+        specs = tuple((x.__class__ is Symbol, x) for x in reversed(exprs))
+        needs = ("env",) if any(lk for lk, _ in specs) else ()
+        return vm_seq(needs, ("argl",), (VM_ARGS, specs))
+    rest = vm_seq(("argl",), ("argl",), (VM_ARGL_DONE,))
+    for x in reversed(exprs):
+        push = vm_preserving(
+            ("argl",),
+            vm_compile(ctx, x, "val", "next", scope),
+            vm_seq(("val", "argl"), ("argl",), (VM_ARGL_PUSH,)),
+        )
+        rest = vm_preserving(("env",), push, rest)
+    return vm_append(vm_seq((), ("argl",), (VM_ARGS, ())), rest)
+
+
+def vm_compile_application(ctx, op, args, scope, linkage):
+    exprs = []
+    a = args
+    while a is not EL:
+        if a.__class__ is not list:
+            raise SyntaxError(f"expected list, got {a!r}")
+        x, a = a
+        exprs.append(x)
+    call = Label()
+    if linkage == "return":
+        ret = None
+        tail = vm_seq(("proc", "argl", "env", "cont"), VM_ALL, call)
+        tail.code.append((VM_CALL, None))
+    else:
+        ret = Label() if linkage == "next" else linkage
+        tail = vm_seq(("proc", "argl", "env"), VM_ALL, call, (VM_CALL, ret))
+        if linkage == "next":
+            tail.code.append(ret)
+    check = vm_seq(("proc",), ("argl",), (VM_CHECK, args, call))
+    return vm_preserving(
+        ("env", "cont"),
+        vm_compile(ctx, op, "proc", "next", scope),
+        vm_append(
+            check,
+            vm_preserving(
+                ("proc", "env", "cont"),
+                vm_compile_args(ctx, exprs, scope),
+                tail,
+            ),
+        ),
+    )
+
+
+def vm_compile_let(ctx, syms, exprs, body, scope, linkage, star=False):
+    ## pylint: disable=too-many-arguments, too-many-positional-arguments
+    ## bind syms to the values of exprs in a new env and run body there.
+    ## let* is a chain of one-binding lets.
+    if star and len(syms) > 1:
+        syms, exprs, rest = syms[:1], exprs[:1], (syms[1:], exprs[1:])
+    else:
+        rest = None
+    names = dict.fromkeys(syms, T)
+    if rest is None:
+        scan_defines(ctx, body, names)
+    inner = Scope(names, scope, scope.env)
+    if rest is None:
+        b = vm_compile(ctx, body, "val", linkage, inner)
+    else:
+        b = vm_compile_let(ctx, *rest, body, inner, linkage, True)
+    return vm_preserving(
+        ("env", "cont"),
+        vm_compile_args(ctx, exprs, scope),
+        vm_append(
+            vm_seq(("env", "argl"), ("env",), (VM_BIND, tuple(syms))), b
+        ),
+    )
+
+
+def vm_compile_letrec(ctx, syms, exprs, body, scope, linkage):
+    ## pylint: disable=too-many-arguments, too-many-positional-arguments
+    names = dict.fromkeys(syms, T)
+    scan_defines(ctx, body, names)
+    inner = Scope(names, scope, scope.env)
+    ret = vm_compile(ctx, body, "val", linkage, inner)
+    for sym, x in reversed(list(zip(syms, exprs))):
+        value = vm_compile(ctx, x, "val", "next", inner)
+        ret = vm_preserving(
+            ("env", "cont"), vm_compile_define(sym, value, "next"), ret
+        )
+    return vm_append(
+        vm_seq(("env",), ("env",), (VM_EXTEND, tuple(set(syms)))), ret
+    )
+
+
+def vm_assemble(seq):
+    ## place the labels and turn jump targets into code indices
+    code = []
+    for i in seq.code:
+        if i.__class__ is Label:
+            i.code = code
+            i.pc = len(code)
+        else:
+            code.append(i)
+    for n, i in enumerate(code):
+        op = i[0]
+        if op in (VM_BRANCH, VM_GOTO):
+            code[n] = (op, i[1].pc)
+        elif op == VM_CHECK:
+            code[n] = (op, i[1], i[2].pc)
+    return code
+
+
+def vm_run(ctx, code, pc):
+    ## pylint: disable=no-member, not-callable, too-many-branches
+    ## pylint: disable=too-many-locals, too-many-nested-blocks
+    ## pylint: disable=too-many-statements
+    val = ctx.val
+    env = ctx.env
+    argl = ctx.argl
+    cont = ctx.cont
+    s = ctx.s
+    proc = EL
+    while True:
+        i = code[pc]
+        pc += 1
+        op = i[0]
+        ## most frequent first
+        if op == VM_PROC_LOOKUP:
+            x = i[1]
+            e = env
+            while x not in e:
+                e = e[SENTINEL]
+                if e is SENTINEL:
+                    raise NameError(str(x))
+            proc = e[x]
+        elif op == VM_CHECK:
+            try:
+                if proc.special:
+                    argl = i[1]
+                    pc = i[2]
+            except AttributeError:
+                raise SyntaxError(f"expected callable, got {proc!r}") from None
+        elif op == VM_ARGS:
+            argl = EL
+            for lk, x in i[1]:
+                if lk:
+                    e = env
+                    while x not in e:
+                        e = e[SENTINEL]
+                        if e is SENTINEL:
+                            raise NameError(str(x))
+                    x = e[x]
+                argl = [x, argl]
+        elif op == VM_CALL:
+            if proc.leaf:
+                ## no need to leave the loop
+                ctx.argl = argl
+                proc(ctx)
+                val = ctx.val
+                r = cont if i[1] is None else i[1]
+                if r.__class__ is not Label:
+                    ctx.env = env
+                    ctx.s = s
+                    ctx.cont = cont
+                    return r
+                code = r.code
+                pc = r.pc
+                continue
+            if i[1] is not None:
+                cont = i[1]
+            ctx.argl = argl
+            ctx.env = env
+            ctx.cont = cont
+            ctx.s = s
+            if proc.ffi:
+                ctx.exp = proc
+                return k_ffi
+            r = proc(ctx)
+            if r.__class__ is not Label or ctx.budget is not None:
+                ## under a budget every call bounces, so it is charged.
+                ## atrampoline and trampoline_counted set an unlimited
+                ## one to see every call as well
+                return r
+            code = r.code
+            pc = r.pc
+            val = ctx.val
+            env = ctx.env
+            argl = ctx.argl
+            cont = ctx.cont
+            s = ctx.s
+        elif op == VM_SAVE_ENV:
+            s = [env, s]
+        elif op == VM_RESTORE_ENV:
+            env, s = s
+        elif op == VM_SAVE_ARGL:
+            s = [argl, s]
+        elif op == VM_RESTORE_ARGL:
+            argl, s = s
+        elif op == VM_ARGL_PUSH:
+            argl = [val, argl]
+        elif op == VM_SAVE_CONT:
+            s = [cont, s]
+        elif op == VM_RESTORE_CONT:
+            cont, s = s
+        elif op == VM_VAL_LOOKUP:
+            x = i[1]
+            e = env
+            while x not in e:
+                e = e[SENTINEL]
+                if e is SENTINEL:
+                    raise NameError(str(x))
+            val = e[x]
+        elif op == VM_BRANCH:
+            if val is EL:
+                pc = i[1]
+        elif op == VM_RETURN:
+            if cont.__class__ is not Label:
+                ctx.val = val
+                ctx.env = env
+                ctx.argl = argl
+                ctx.s = s
+                ctx.cont = cont
+                return cont
+            code = cont.code
+            pc = cont.pc
+        elif op == VM_VAL_CONST:
+            val = i[1]
+        elif op == VM_ARGL_DONE:
+            a = EL
+            while argl is not EL:
+                x, argl = argl
+                a = [x, a]
+            argl = a
+        elif op == VM_SAVE_PROC:
+            s = [proc, s]
+        elif op == VM_RESTORE_PROC:
+            proc, s = s
+        elif op == VM_GOTO:
+            pc = i[1]
+        elif op == VM_PROC_VAL:
+            proc = val
+        elif op == VM_BIND:
+            e = {SENTINEL: env}
+            for sym in i[1]:
+                e[sym], argl = argl
+            env = e
+        elif op == VM_PROC_CONST:
+            proc = i[1]
+        elif op == VM_LAMBDA:
+            val = i[1](env)
+        elif op == VM_DEFINE:
+            if ctx.prof is not None:
+                val = ctx.prof.wrap(i[1], val)
+            env[i[1]] = val
+            val = EL
+        elif op == VM_SET:
+            env_assign(env, i[1], val)
+            val = EL
+        elif op == VM_EXTEND:
+            e = dict.fromkeys(i[1], EL)
+            e[SENTINEL] = env
+            env = e
+        elif op == VM_INTERP:
+            if i[2] is not None:
+                cont = i[2]
+            ctx.val = val
+            ctx.env = env
+            ctx.argl = argl
+            ctx.s = s
+            ctx.cont = cont
+            ctx.exp = i[1]
+            return k_leval
+        else:
+            raise RuntimeError(f"bad opcode {op!r}")
+
+
+def vm_compile_lambda(ctx, params, body, scope):
+    ## pylint: disable=no-member
+    ## compile a lambda body to vm code. returns make(env) which creates
+    ## the closure each time the lambda is evaluated.
+    fixed, rest = compile_params(ctx, params)
+    names = dict.fromkeys(fixed, T)
+    if rest is not None:
+        names[rest] = T
+    scan_defines(ctx, body, names)
+    inner = Scope(names, scope, scope.env)
+    entry = Label()
+    ## entry keeps the assembled code alive; see vm_assemble()
+    vm_assemble(
+        vm_append(
+            vm_seq((), (), entry),
+            vm_compile(ctx, body, "val", "return", inner),
+        )
+    )
+
+    def special(ctx):
+        ctx.env = create_environment(ctx, params, ctx.argl, ctx.env)
+        return entry
+
+    if rest is None and len(fixed) == 0:
+
+        def make(env):
+            def lcall(ctx):
+                if lcall.special:
+                    return special(ctx)
+                if ctx.argl is not EL:
+                    raise SyntaxError("too many args")
+                ctx.env = {SENTINEL: env}
+                return entry
+
+            return finish_closure(lcall, params, body, env)
+
+    elif rest is None and len(fixed) == 1:
+        (p,) = fixed
+
+        def make(env):
+            def lcall(ctx):
+                if lcall.special:
+                    return special(ctx)
+                try:
+                    x, a = ctx.argl
+                except TypeError:
+                    raise SyntaxError("not enough args") from None
+                if a is not EL:
+                    raise SyntaxError("too many args")
+                ctx.env = {SENTINEL: env, p: x}
+                return entry
+
+            return finish_closure(lcall, params, body, env)
+
+    elif rest is None and len(fixed) == 2:
+        p, q = fixed
+
+        def make(env):
+            def lcall(ctx):
+                if lcall.special:
+                    return special(ctx)
+                try:
+                    x, a = ctx.argl
+                    y, a = a
+                except TypeError:
+                    raise SyntaxError("not enough args") from None
+                if a is not EL:
+                    raise SyntaxError("too many args")
+                ctx.env = {SENTINEL: env, p: x, q: y}
+                return entry
+
+            return finish_closure(lcall, params, body, env)
+
+    else:
+
+        def make(env):
+            def lcall(ctx):
+                parent = ctx.env if lcall.special else env
+                ctx.env = create_environment(ctx, params, ctx.argl, parent)
+                return entry
+
+            return finish_closure(lcall, params, body, env)
+
+    return make
+
+
+def create_vm_lambda(ctx, params, body, env):
+    return vm_compile_lambda(ctx, params, body, frame_scope(env))(env)
+
+
+## }}}
+## {{{ engines
+
+
+def interp_engine(_):
+    return create_lambda
+
+
+def compiled_engine(ctx):
+    def lam(params, body, env):
+        return create_compiled_lambda(ctx, params, body, env)
+
+    return lam
+
+
+def vm_engine(ctx):
+    def lam(params, body, env):
+        return create_vm_lambda(ctx, params, body, env)
+
+    return lam
+
+
+ENGINES = {
+    "compiled": compiled_engine,
+    "interp": interp_engine,
+    "vm": vm_engine,
+}
+
+
 ## }}}
 ## {{{ list builder
 
@@ -613,7 +2804,7 @@ def k_ffi(ctx):
     ctx.push(ctx.exp)  ## proc
 
     if ctx.argl is EL:
-        ctx.argl = []
+        ctx.val = []
         return k_ffi_args_done
     ctx.cont = k_ffi_args_done
     ctx.exp = ctx.argl
@@ -624,9 +2815,21 @@ def k_ffi_args_done(ctx):
     proc = ctx.pop()
     ctx.cont = ctx.pop()
     ctx.exp = proc(ctx.val)
+    if hasattr(ctx.exp, "__await__"):
+        return k_await
     return k_py_value_to_lisp_value
 
 
+def k_await(ctx):
+    ## an ffi function returned an awaitable. Context.atrampoline()
+    ## awaits it instead of calling this; the others can't
+    x = ctx.exp
+    if hasattr(x, "close"):
+        ## no "never awaited" warning
+        x.close()
+    raise TypeError(f"ffi returned an awaitable outside aleval: {x!r}")
+
+
 def k_lisp_value_to_py_value(ctx):
     x = ctx.exp
     if x is EL:
@@ -695,137 +2898,422 @@ def k_pv2lv_next(ctx):
     return k_pv2lv_setup(ctx, args)
 
 
+## }}}
+## {{{ profiler
+
+## a lisp level profiler. in cps there's no python stack that says which
+## lisp function is running, so while ctx.prof is set every define wraps
+## the lambda it binds in a Profiled that, when called, pushes a Mark
+## with its caller's continuation on ctx.s and continues to
+## k_prof_return, which pops it and charges the elapsed time. the
+## marks are the call stack: call/cc saves and restores them along with
+## everything else, and a tail call replaces its caller's mark instead
+## of stacking another one, so loops still run in constant space. a
+## frame that is escaped from is never charged; its time stays with its
+## caller. anonymous lambdas count as part of the function they run in,
+## and the collapsed stacks fold direct recursion into one frame.
+
+
+class Mark:
+    ## pylint: disable=too-few-public-methods
+    ## one profiled call: up is the caller's Mark or None, sub the time
+    ## spent in profiled callees, path an id for the chain of keys. t0
+    ## is None once it has been charged
+    __slots__ = ("key", "t0", "sub", "up", "path")
+
+    def __init__(self, key, t0, up, path):
+        self.key = key
+        self.t0 = t0
+        self.sub = 0.0
+        self.up = up
+        self.path = path
+
+
+class Profiled:
+    ## a named lambda whose calls prof times. attributes are the
+    ## lambda's, so .special and friends work as before
+    __slots__ = ("prof", "key", "func")
+
+    def __init__(self, prof, key, func):
+        object.__setattr__(self, "prof", prof)
+        object.__setattr__(self, "key", key)
+        object.__setattr__(self, "func", func)
+
+    def __call__(self, ctx):
+        self.prof.enter(ctx, self.key)
+        return self.func(ctx)
+
+    def __getattr__(self, name):
+        return getattr(self.func, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.func, name, value)
+
+
+def k_prof_return(ctx):
+    mark, s = ctx.s
+    ctx.cont, ctx.s = s
+    prof = ctx.prof
+    if prof is not None:
+        prof.leave(mark, prof.clock())
+    return ctx.cont
+
+
+class Profiler:
+    ## pylint: disable=too-many-instance-attributes
+    ## set ctx.prof = Profiler() before the code to profile is defined.
+    ## keys are pstats style (file, line, name) tuples. lisp forms carry
+    ## no line numbers, so file is always "<lisp>" and line 0; instead,
+    ## the second lambda body bound to a name gets "name#2" and so on,
+    ## so that, e.g., two inner functions called loop are kept apart
+
+    def __init__(self):
+        self.clock = time.perf_counter
+        self.keys = {}
+        self.names = {}
+        self.bodies = []
+        self.stats = {}
+        self.active = {}
+        self.cur = None
+        self.paths = {}
+        self.folded = {}
+
+    def wrap(self, sym, value):
+        ## value, timed under sym's name if it is a lisp lambda
+        if value.__class__ is Profiled:
+            return value
+        lam = getattr(value, "lambda_", None)
+        if lam is None or value.special:
+            return value
+        k = (str(sym), id(lam[1]))
+        key = self.keys.get(k)
+        if key is None:
+            name = k[0]
+            n = self.names[name] = self.names.get(name, 0) + 1
+            if n > 1:
+                name = f"{name}#{n}"
+            key = self.keys[k] = ("<lisp>", 0, name)
+            ## keep the body alive so its id isn't reused
+            self.bodies.append(lam[1])
+        return Profiled(self, key, value)
+
+    def enter(self, ctx, key):
+        now = self.clock()
+        if ctx.cont is k_prof_return:
+            ## tail call, the caller's frame is gone from here on
+            mark, s = ctx.s
+            self.leave(mark, now)
+            up = mark.up
+        else:
+            s = ctx.s
+            up = None
+            while s is not EL:
+                x, s = s
+                if x.__class__ is Mark:
+                    up = x
+                    break
+            if up is not self.cur:
+                ## a continuation was called since the last call/return
+                self.resync(up)
+            s = [ctx.cont, ctx.s]
+            ctx.cont = k_prof_return
+        if up is not None and up.key is key:
+            ## fold direct recursion, deep stacks would get huge
+            path = up.path
+        else:
+            pk = (-1 if up is None else up.path, key)
+            path = self.paths.get(pk)
+            if path is None:
+                path = self.paths[pk] = len(self.paths)
+        mark = Mark(key, now, up, path)
+        ctx.s = [mark, s]
+        self.active[key] = self.active.get(key, 0) + 1
+        self.cur = mark
+
+    def leave(self, mark, now):
+        if mark.t0 is None:
+            ## returning through a frame a second time, by way of a
+            ## continuation saved before it was left; it's charged once
+            self.resync(mark.up)
+            return
+        if mark is not self.cur:
+            self.resync(mark)
+        elapsed = now - mark.t0
+        mark.t0 = None
+        own = elapsed - mark.sub
+        up = mark.up
+        self.cur = up
+        key = mark.key
+        n = self.active[key] - 1
+        self.active[key] = n
+        st = self.stats.get(key)
+        if st is None:
+            st = self.stats[key] = [0, 0, 0.0, 0.0, {}]
+        self.charge(st, n, own, elapsed)
+        if up is not None:
+            up.sub += elapsed
+            c = st[4].get(up.key)
+            if c is None:
+                c = st[4][up.key] = [0, 0, 0.0, 0.0]
+            self.charge(c, n, own, elapsed)
+        self.folded[mark.path] = self.folded.get(mark.path, 0.0) + own
+
+    @staticmethod
+    def charge(st, n, own, elapsed):
+        ## primitive calls and cumulative time skip recursive calls
+        if not n:
+            st[0] += 1
+            st[3] += elapsed
+        st[1] += 1
+        st[2] += own
+
+    def resync(self, mark):
+        ## rebuild the active counts for the chain ending at mark
+        active = {}
+        x = mark
+        while x is not None:
+            active[x.key] = active.get(x.key, 0) + 1
+            x = x.up
+        self.active = active
+        self.cur = mark
+
+    def pstats(self):
+        ## the dict that pstats.Stats loads from a file
+        ret = {}
+        for key, st in self.stats.items():
+            callers = {k: tuple(v) for k, v in st[4].items()}
+            ret[key] = (st[0], st[1], st[2], st[3], callers)
+        return ret
+
+    def dump_stats(self, filename):
+        ## pstats.Stats(filename) reads this
+        with open(filename, "wb") as fp:
+            marshal.dump(self.pstats(), fp)
+
+    def collapsed(self):
+        ## "f;g;h usecs" lines of own time for flamegraph.pl and friends
+        names = {-1: None}
+        for (up, key), path in self.paths.items():
+            names[path] = (up, key[2])
+        memo = {}
+
+        def name(path):
+            ret = memo.get(path)
+            if ret is None:
+                ## iterative, recursion can make these deep
+                chain = []
+                p = path
+                while p != -1 and p not in memo:
+                    chain.append(p)
+                    p = names[p][0]
+                ret = memo.get(p)
+                for p in reversed(chain):
+                    n = names[p][1]
+                    ret = n if ret is None else ret + ";" + n
+                    memo[p] = ret
+            return ret
+
+        return [
+            f"{name(path)} {round(t * 1e6)}"
+            for path, t in self.folded.items()
+            if round(t * 1e6)
+        ]
+
+    def dump_collapsed(self, filename):
+        with open(filename, "w", encoding="utf-8") as fp:
+            for line in self.collapsed():
+                fp.write(line + "\n")
+
+
 ## }}}
 ## {{{ scanner and parser
 
 
+## the scanner works on whole buffers: TOKEN skips blanks and finds the
+## next token, and numbers are told from symbols by INT_RE and FLOAT_RE,
+## which accept exactly what int(t, 0) and float(t) do for plain ascii
+## tokens, so no exceptions get raised for symbols like "define" or
+## "cadr". a token that may continue in the next buffer (a symbol,
+## string, comment, or comma at the very end) is held back until more
+## text or eof arrives. a buffer can also be bytes-like, e.g., an mmap;
+## then TOKEN_B scans it in place and only the tokens get decoded.
+
+TOKEN = re.compile(
+    r"""[ \n\r\t]*(?:
+    ([^()\[\] \n\r\t;"',`]+)(["',`])?  ## 1: symbol or number, 2: junk
+    |(\()|(\[)                      ## 3, 4: open
+    |(\))|(\])                      ## 5, 6: close
+    |("(?:[^"\\]|\\.)*")            ## 7: string
+    |(,@|[',`])                     ## 8: quotes
+    |(;[^\n\r]*)                    ## 9: comment
+    )?""",
+    re.X | re.S,
+)
+
+TOKEN_B = re.compile(TOKEN.pattern.encode("ascii"), re.X | re.S)
+
+INT_RE = re.compile(
+    r"""[-+]?(?:
+        0[xX](?:_?[0-9a-fA-F])+
+        |0[oO](?:_?[0-7])+
+        |0[bB](?:_?[01])+
+        |[1-9](?:_?[0-9])*
+        |0(?:_?0)*
+    )\Z""",
+    re.X,
+)
+
+FLOAT_RE = re.compile(
+    r"""[-+]?(?:
+        (?:[0-9](?:_?[0-9])*)?\.[0-9](?:_?[0-9])*(?:e[-+]?[0-9](?:_?[0-9])*)?
+        |[0-9](?:_?[0-9])*\.?(?:e[-+]?[0-9](?:_?[0-9])*)?
+        |inf(?:inity)?
+        |nan
+    )\Z""",
+    re.X | re.I,
+)
+
+PLAIN_RE = re.compile(r"[\w.+-]*\Z", re.A)
+
+ESC_RE = re.compile(r"\\(.)", re.S)
+
+
 class Parser:
     ## pylint: disable=too-many-instance-attributes
+    ## the stacks are python lists here, the parser is hot enough
 
-    S_SYM = 0
-    S_COMMENT = 1
-    S_STRING = 2
-    S_ESC = 3
-    S_COMMA = 4
-
-    def __init__(self, ctx, callback):
+    def __init__(self, ctx, callback, encoding="utf-8"):
         self.ctx = ctx
         self.callback = callback
+        self.encoding = encoding  ## for bytes-like buffers
         self.qt = ctx.q  ## quotes and replacements
-        self.pos = [0]  ## yup, a list, see feed() and S_COMMA code
-        self.token = []
-        self.add = self.token.append
-        self.parens = EL  ## () and [] pairing
-        self.qstack = EL  ## parser quotes
-        self.lstack = EL  ## parsed lists
-        self.stab = (  ## this corresponds to the S_* index constants
-            self.do_sym,
-            self.do_comment,
-            self.do_string,
-            self.do_esc,
-            self.do_comma,
-        )
-        self.state = self.S_SYM
+        self.rest = ""  ## unfinished token from the last buffer
+        self.parens = []  ## () and [] pairing
+        self.qstack = []  ## parser quotes, SENTINEL marks an open paren
+        self.lstack = []  ## items of the open lists
+        self.bsyms = {}  ## encoded name -> symbol for bytes-like buffers
 
     def feed(self, text):
-        if text is None:
-            self.sym()
-            if self.state not in (self.S_SYM, self.S_COMMENT):
-                raise SyntaxError("eof in {self.state!r}")
-            if self.parens is not EL:
-                raise SyntaxError(f"eof expecting {self.parens[0]!r}")
-            if self.qstack is not EL:
-                raise SyntaxError("unclosed quasiquote")
-            return
-        pos = self.pos
-        n = len(text)
-        stab = self.stab
-        p = pos[0] = 0
-        while p < n:
-            stab[self.state](text[p])
-            p = pos[0] = pos[0] + 1  ## re-read in case of comma adjustment
-
-    def append(self, x):
-        if self.lstack is EL:
-            self.callback(self.quote_wrap(x))
+        ## pylint: disable=too-many-branches, too-many-locals
+        ## pylint: disable=too-many-statements
+        final = text is None
+        if final:
+            text = self.rest
+        elif self.rest:
+            text = self.rest + text
+        self.rest = ""
+        if text.__class__ is str:
+            match, enc = TOKEN.match, None
         else:
-            self.lstack[0].append(self.quote_wrap(x))
-
-    def quote_wrap(self, x):
-        qs = self.qstack
-        while qs is not EL and qs[0].__class__ is Symbol:
-            q, qs = qs
-            x = [q, [x, EL]]
-        self.qstack = qs
-        return x
-
-    def sym(self):
-        if self.token:
-            t = "".join(self.token)
-            self.token.clear()  ## faster than del[:]
-            if t[0].lower() in "0123456789-.+abcdef":
-                try:
-                    t = int(t, 0)
-                except ValueError:
-                    try:
-                        t = float(t)
-                    except:  ## pylint: disable=bare-except
-                        t = self.ctx.symbol(t)
-            else:
-                t = self.ctx.symbol(t)
-            self.append(t)
-
-    def do_sym(self, ch):
-        ## pylint: disable=too-many-branches
-        if ch in "()[] \n\r\t;\"',`":  ## all of this is actually faster.
-            if ch in "([":
-                self.sym()
-                ## faster than a lut:
-                self.parens = [")" if ch == "(" else "]", self.parens]
-                self.qstack = [SENTINEL, self.qstack]
-                self.lstack = [ListBuilder(), self.lstack]
-            elif ch in ")]":
-                self.sym()
-                if self.parens is EL:
+            match, enc = TOKEN_B.match, self.encoding
+        n = len(text)
+        pos = 0
+        symbol = self.ctx.symbol
+        parens, qs, ls = self.parens, self.qstack, self.lstack
+        bsyms = self.bsyms
+        callback = self.callback
+        while pos < n:
+            m = match(text, pos)
+            end = m.end()
+            k = m.lastindex
+            if k == 1:
+                if end == n and not final:
+                    self.rest = text[m.start(1) :]
+                    return
+                x = m.group(1)
+                if enc:
+                    ## skip decoding symbols seen before
+                    t = x
+                    x = bsyms.get(t)
+                    if x is None:
+                        x = str(t, enc)
+                        if x[0] in "0123456789-.+":
+                            x = self.number(x)
+                        else:
+                            x = bsyms[t] = symbol(x)
+                elif x[0] in "0123456789-.+":
+                    x = self.number(x)
+                else:
+                    x = symbol(x)
+            elif k in (3, 4):
+                parens.append(")" if k == 3 else "]")
+                qs.append(SENTINEL)
+                ls.append([])
+                pos = end
+                continue
+            elif k in (5, 6):
+                ch = ")" if k == 5 else "]"
+                if not parens:
                     raise SyntaxError(f"too many {ch!r}")
-                p, self.parens = self.parens
-                if p != ch:
+                if parens.pop() != ch:
                     raise SyntaxError(f"unexpected {ch!r}")
-                self.qstack = self.qstack[1]
-                lb, self.lstack = self.lstack
-                self.append(lb.get())
-            elif ch in " \n\r\t":
-                self.sym()
-            elif ch == ";":
-                self.sym()
-                self.state = self.S_COMMENT
+                qs.pop()
+                x = EL
+                for y in reversed(ls.pop()):
+                    x = [y, x]
+            elif k == 7:
+                x = m.group(7)
+                x = self.string(str(x, enc) if enc else x)
+            elif k == 8:
+                q = m.group(8)
+                if enc:
+                    q = str(q, enc)
+                if q == "," and end == n:
+                    if not final:
+                        self.rest = text[end - 1 :]
+                        return
+                    raise SyntaxError("eof after ','")
+                qs.append(self.qt[q])
+                pos = end
+                continue
+            elif k == 9:
+                if end == n and not final:
+                    self.rest = text[m.start(9) :]
+                    return
+                pos = end
+                continue
+            elif k == 2:
+                ch = m.group(2)
+                ch = str(ch, enc) if enc else ch
+                raise SyntaxError(f"{ch!r} not a delimiter")
+            elif end == n:
+                ## trailing blanks
+                break
             else:
-                ## less common cases that aren't delimiters: ["] ['] [,] [`]
-                if self.token:
-                    raise SyntaxError(f"{ch!r} not a delimiter")
-                if ch == '"':
-                    self.state = self.S_STRING
+                ## an unterminated string
+                if not final:
+                    self.rest = text[end:]
                     return
-                if ch in "'`":
-                    self.qstack = [self.qt[ch], self.qstack]
-                else:
-                    self.state = self.S_COMMA
-        else:
-            self.add(ch)
-
-    def do_comment(self, ch):
-        if ch in "\n\r":
-            self.state = self.S_SYM
-
-    def do_string(self, ch):
-        if ch == '"':
-            self.append("".join(self.token))
-            self.token.clear()  ## faster than del[:]
-            self.state = self.S_SYM
-        elif ch == "\\":
-            self.state = self.S_ESC
-        else:
-            self.add(ch)
+                raise SyntaxError("eof in string")
+            pos = end
+            while qs and qs[-1] is not SENTINEL:
+                x = [qs.pop(), [x, EL]]
+            if ls:
+                ls[-1].append(x)
+            else:
+                callback(x)
+        if final:
+            if parens:
+                raise SyntaxError(f"eof expecting {parens[-1]!r}")
+            if qs:
+                raise SyntaxError("unclosed quasiquote")
+
+    def number(self, t):
+        ## t starts with a digit, sign, or dot. return a number or symbol.
+        if INT_RE.match(t):
+            return int(t, 0)
+        if FLOAT_RE.match(t):
+            return float(t)
+        if not PLAIN_RE.match(t):
+            ## unicode digits and such, let python decide
+            try:
+                return int(t, 0)
+            except ValueError:
+                try:
+                    return float(t)
+                except ValueError:
+                    pass
+        return self.ctx.symbol(t)
 
     ESC = {
         "\\": "\\",
@@ -835,47 +3323,479 @@ class Parser:
         '"': '"',
     }
 
-    def do_esc(self, ch):
-        c = self.ESC.get(ch)
-        if c is None:
-            raise SyntaxError(f"bad escape {ch!r}")
-        self.add(c)
-        self.state = self.S_STRING
+    def string(self, t):
+        t = t[1:-1]
+        if "\\" not in t:
+            return t
+        esc = self.ESC
+
+        def sub(m):
+            c = esc.get(m.group(1))
+            if c is None:
+                raise SyntaxError(f"bad escape {m.group(1)!r}")
+            return c
+
+        return ESC_RE.sub(sub, t)
+
 
-    def do_comma(self, ch):
-        if ch == "@":
-            q = self.qt[",@"]
+## }}}
+## {{{ parsed-ast cache
+
+## load() keeps the parsed forms of each file in __lispcache__/ next to
+## it, like python's __pycache__, and reuses them as long as the path,
+## mtime, size, and AST_CACHE_TAG match. if that directory isn't
+## writable the cache goes to $LISP_CACHE_DIR or ~/.cache/sisoap, and if
+## that fails too the file just isn't cached. symbols are stored by name
+## and interned into the loading context by ast_decode().
+
+AST_CACHE_VERSION = 1  ## bump when the parser's output changes
+AST_CACHE_TAG = f"{sys.implementation.cache_tag}-ast{AST_CACHE_VERSION}"
+AST_CACHE_SUFFIX = f"{AST_CACHE_TAG}.lispc"
+AST_CACHE_LIMIT = 1 << 24  ## bigger files aren't cached
+
+
+def ast_encode(x):
+    ## marshal-able form of a parsed expression: lists become python
+    ## lists, symbols 1-tuples, and () None
+    if x is EL:
+        return None
+    t = x.__class__
+    if t is Symbol:
+        return (x.s,)
+    if t is list:
+        ret = []
+        while x is not EL:
+            y, x = x
+            ret.append(ast_encode(y))
+        return ret
+    return x
+
+
+def ast_decode(ctx, x):
+    if x is None:
+        return EL
+    t = x.__class__
+    if t is tuple:
+        return ctx.symbol(x[0])
+    if t is list:
+        ret = EL
+        for y in reversed(x):
+            ret = [ast_decode(ctx, y), ret]
+        return ret
+    return x
+
+
+def cache_paths(path, suffix):
+    ## where to look for the cached data for path
+    path = os.path.abspath(path)
+    d, base = os.path.split(path)
+    name = f"{base}.{suffix}"
+    yield os.path.join(d, "__lispcache__", name)
+    root = os.environ.get("LISP_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "sisoap"
+    )
+    h = hashlib.sha256(path.encode("utf-8", "surrogateescape"))
+    yield os.path.join(root, f"{h.hexdigest()[:16]}-{name}")
+
+
+def cache_read(path, suffix, key):
+    ## return the value cached for path under key or None
+    for cpath in cache_paths(path, suffix):
+        try:
+            with open(cpath, "rb") as fp:
+                k, value = marshal.loads(fp.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            continue
+        if k == key:
+            return value
+    return None
+
+
+def cache_write(path, suffix, key, value):
+    ## value must be marshal-able
+    data = marshal.dumps((key, value))
+    for cpath in cache_paths(path, suffix):
+        tmp = f"{cpath}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cpath), exist_ok=True)
+            with open(tmp, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp, cpath)
+            return True
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+    return False
+
+
+## }}}
+## {{{ global env snapshots
+##
+## snapshot_dump() flattens the global env into a marshal-able node
+## table: primitives are stored by their G__ name, symbols by name, and
+## lambdas as (params, body, env, special) with every pair, env, and
+## lambda stored once and referred to by index, so sharing and cycles
+## survive. snapshot_load() rebuilds it in a fresh context, creating the
+## lambdas with ctx.lam() so a snapshot works with any engine. other
+## objects take part if they have a snapshot_() method that returns a
+## name and a lisp value holding their state: the name picks a maker
+## registered with @snapshot_maker(name) which returns a new, empty
+## object and a function that fills it from the state, called once all
+## else is loaded so that cycles through the object survive. anything
+## else (ffi objects, continuations) is a TypeError. the same format
+## carries any other value along with some of the global bindings, see
+## snapshot_globals(); every global env in it then becomes the one that
+## snapshot_load() fills, and compiled Frames become dict envs.
+
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_MAKERS = {}
+
+
+def snapshot_maker(name):
+    def wrap(func):
+        SNAPSHOT_MAKERS[name] = func
+        return func
+
+    return wrap
+
+
+def snapshot_key(text):
+    ## identifies a snapshot of the env created by evaluating text
+    h = hashlib.sha256(text.encode("utf-8"))
+    h.update("\0".join(sorted(G__)).encode("utf-8"))
+    return (AST_CACHE_TAG, SNAPSHOT_VERSION, h.hexdigest())
+
+
+def env_items(env):
+    ## the (key, value) pairs of a dict env or a Frame, parent included
+    if env.__class__ is not Frame:
+        return env.items()
+    ret = [(SENTINEL, env.up)]
+    for k, i in env.names.items():
+        if env.v[i] is not SENTINEL:
+            ret.append((k, env.v[i]))
+    if env.x is not None:
+        ret.extend(env.x.items())
+    return ret
+
+
+def snapshot_globals(ctx, x):
+    ## the global bindings x can reach through the symbols in it and the
+    ## values they're bound to, for snapshot_dump(ctx, x, genv). leaves
+    ## out primitives bound to their usual names since every ctx has them
+    ret = {}
+    seen = set()
+    todo = [x]
+    while todo:
+        x = todo.pop()
+        t = x.__class__
+        if t is Symbol:
+            if x in ret:
+                continue
+            e = ctx.g
+            while e is not SENTINEL and x not in e:
+                e = e[SENTINEL]
+            if e is SENTINEL:
+                continue
+            v = e[x]
+            if G__.get(x.s) is not v:
+                ret[x] = v
+                todo.append(v)
+        elif t is Globals or id(x) in seen:
+            continue
+        elif t is list:
+            seen.add(id(x))
+            todo.extend(x)
+        elif t is dict or t is Frame:
+            seen.add(id(x))
+            todo.extend(v for _, v in env_items(x))
+        elif hasattr(x, "lambda_"):
+            seen.add(id(x))
+            todo.extend(x.lambda_)
+            todo.append(x.env)
+        elif hasattr(x, "snapshot_"):
+            seen.add(id(x))
+            todo.append(x.snapshot_()[1])
+    return ret
+
+
+def snapshot_dump(ctx, root=SENTINEL, genv=None):
+    ## pylint: disable=too-many-branches, too-many-locals
+    ## pylint: disable=too-many-return-statements, too-many-statements
+    ## root defaults to ctx.g, genv, the global bindings to store, to all
+    ## of ctx.g
+    prims = {id(v): k for k, v in G__.items()}
+    g = ctx.g
+    if genv is None:
+        genv = g
+
+    def is_node(x):
+        t = x.__class__
+        return (
+            t is list
+            or t is dict
+            or t is Globals
+            or t is Frame
+            or hasattr(x, "lambda_")
+            or hasattr(x, "snapshot_")
+        )
+
+    ## (name, state) by id for the objects with a snapshot_() method. the
+    ## state is made once and kept here so that its pairs are counted
+    ## below, and their ids stay taken, until they're stored
+    objs = {}
+
+    ## count the references to each pair so that proper lists nobody
+    ## else points into can be stored inline as python lists
+    refs = {}
+    todo = [g if root is SENTINEL else root]
+    while todo:
+        x = todo.pop()
+        if x.__class__ is Globals:
+            x = g
+        n = refs.get(id(x), 0)
+        refs[id(x)] = n + 1
+        if n:
+            continue
+        t = x.__class__
+        if t is list:
+            todo.extend(x)
+        elif x is g:
+            todo.extend(genv.values())
+        elif t is dict or t is Frame:
+            todo.extend(v for _, v in env_items(x))
+        elif hasattr(x, "lambda_"):
+            todo.extend(x.lambda_)
+            todo.append(getattr(x, "env", None))
+        elif hasattr(x, "snapshot_"):
+            objs[id(x)] = obj = x.snapshot_()
+            todo.append(obj[1])
+
+    def inline(x):
+        ## return the items of x if it can be stored inline, else None
+        items = []
+        while x is not EL:
+            if x.__class__ is not list or refs[id(x)] != 1:
+                return None
+            y, x = x
+            items.append(y)
+        return items
+
+    ids = {}
+    nodes = []
+
+    def ref(x):
+        if x is EL:
+            return None
+        if x is SENTINEL:
+            return ("S",)
+        t = x.__class__
+        if t is Symbol:
+            return ("s", x.s)
+        if t is int or t is float or t is str or t is bool:
+            return x
+        if t is Globals:
+            x = g
+        n = ids.get(id(x))
+        if n is not None:
+            return ("n", n)
+        if not is_node(x):
+            name = prims.get(id(x))
+            if name is None:
+                raise TypeError(f"cannot snapshot {x!r}")
+            return ("p", name)
+        if t is list:
+            items = inline(x)
+            if items is not None:
+                return [ref(y) for y in items]
+        n = ids[id(x)] = len(nodes)
+        nodes.append(None)
+        todo.append(x)
+        return ("n", n)
+
+    root = ref(g if root is SENTINEL else root)
+    while todo:
+        x = todo.pop()
+        t = x.__class__
+        if t is list:
+            node = ("pair", ref(x[0]), ref(x[1]))
+        elif x is g:
+            node = ("genv", [(ref(k), ref(v)) for k, v in genv.items()])
+        elif t is dict or t is Frame:
+            node = ("env", [(ref(k), ref(v)) for k, v in env_items(x)])
+        elif not hasattr(x, "lambda_"):
+            name, state = objs[id(x)]
+            node = ("obj", name, ref(state))
+        else:
+            env = getattr(x, "env", None)
+            if env.__class__ not in (dict, Globals, Frame):
+                raise TypeError(f"cannot snapshot the env of {x!r}")
+            params, body = x.lambda_
+            node = ("lambda", ref(params), ref(body), ref(env), x.special)
+        nodes[ids[id(x)]] = node
+    return (root, nodes)
+
+
+def snapshot_load(ctx, snapshot):
+    ## pylint: disable=too-many-branches, too-many-locals
+    ## pylint: disable=too-many-return-statements
+    ## fill ctx.g from snapshot_dump() output and return its root
+    root, nodes = snapshot
+    symbol = ctx.symbol
+    objs = []
+    fills = []
+    for node in nodes:
+        tag = node[0]
+        if tag == "pair":
+            objs.append([EL, EL])
+        elif tag == "env":
+            objs.append({})
+        elif tag == "genv":
+            objs.append(ctx.g)
+        elif tag == "obj":
+            obj, fill = SNAPSHOT_MAKERS[node[1]](ctx)
+            objs.append(obj)
+            fills.append((fill, node[2]))
         else:
-            ## pos is a list so it can communicate
-            ## with feed() without calling getattr()
-            ## on self. yes, it's actually faster.
-            self.pos[0] -= 1
-            q = self.qt[","]
-        self.qstack = [q, self.qstack]
-        self.state = self.S_SYM
+            objs.append(None)  ## created by lam() below
+
+    def lam(n):
+        _, params, body, env, special = nodes[n]
+        f = objs[n] = ctx.lam(val(params), val(body), val(env))
+        f.special = special
+        return f
+
+    def val(x):
+        if x is None:
+            return EL
+        t = x.__class__
+        if t is list:
+            ret = EL
+            for y in reversed(x):
+                ret = [val(y), ret]
+            return ret
+        if t is tuple:
+            tag = x[0]
+            if tag == "n":
+                n = x[1]
+                ret = objs[n]
+                return lam(n) if ret is None else ret
+            if tag == "s":
+                return symbol(x[1])
+            if tag == "p":
+                return G__[x[1]]
+            return SENTINEL
+        return x
+
+    def is_lambda(x):
+        ## true if x is or (inline) holds a lambda not yet created
+        if x.__class__ is list:
+            return any(is_lambda(y) for y in x)
+        return x.__class__ is tuple and x[0] == "n" and objs[x[1]] is None
+
+    ## fill everything that doesn't refer to a lambda first so that the
+    ## lambdas' bodies are complete when the engine compiles them. the
+    ## rest goes in global definition order, so a lambda made special
+    ## earlier is already bound when later lambdas are compiled.
+    late = []
+    for n, node in enumerate(nodes):
+        tag = node[0]
+        if tag == "pair":
+            p = objs[n]
+            for i in (1, 2):
+                if is_lambda(node[i]):
+                    late.append((p, i - 1, node[i]))
+                else:
+                    p[i - 1] = val(node[i])
+        elif tag in ("env", "genv"):
+            d = objs[n]
+            for k, v in node[1]:
+                if is_lambda(v):
+                    late.append((d, val(k), v))
+                else:
+                    d[val(k)] = val(v)
+    for obj, k, v in late:
+        obj[k] = val(v)
+    for fill, state in fills:
+        fill(val(state))
+    return val(root)
 
 
 ## }}}
 ## {{{ high level parsing routines
 
 
+LOAD_CHUNK = 1 << 16  ## chars per Parser.feed() when reading a file
+
+
 def parse(ctx, text, callback):
     p = Parser(ctx, callback)
     p.feed(text)
     p.feed(None)
 
 
-def execute(ctx, text):
-    results = []
+def parse_file(ctx, fp, callback):
+    ## parse a file object a chunk at a time. each top level form goes
+    ## to callback as soon as it's complete so memory use doesn't depend
+    ## on the size of the file.
+    p = Parser(ctx, callback)
+    read = fp.read
+    while True:
+        text = read(LOAD_CHUNK)
+        if not text:
+            break
+        p.feed(text)
+    p.feed(None)
+
+
+def parse_mapped(ctx, fp, callback, encoding="utf-8"):
+    ## parse a file in place through mmap. the tokenizer scans the mapped
+    ## pages and only decodes the tokens, so processes loading the same
+    ## file share the page cache instead of each holding a str copy of it.
+    ## returns False, having done nothing, if fp can't be mapped, e.g., it
+    ## is a pipe or an empty file.
+    try:
+        m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+    with m:
+        p = Parser(ctx, callback, encoding)
+        p.feed(m)
+        p.feed(None)
+    return True
+
+
+def read_file(ctx, path, mapped=True):
+    ## the top level forms in path as a python list, not evaluated
+    forms = []
+    encoding = locale.getpreferredencoding()
+    with open(path, "r", encoding=encoding) as fp:
+        if not (mapped and parse_mapped(ctx, fp, forms.append, encoding)):
+            parse_file(ctx, fp, forms.append)
+    return forms
+
+
+def execute(ctx, text, keep=True):
+    ## evaluate the forms in text, a string or file object, and return
+    ## their values as a python list if keep else None
+    results = [] if keep else None
 
     def callback(expr):
-        results.append(ctx.leval(expr))
+        value = ctx.leval(expr)
+        if keep:
+            results.append(value)
 
-    parse(ctx, text, callback)
+    if text.__class__ is str:
+        parse(ctx, text, callback)
+    else:
+        parse_file(ctx, text, callback)
     return results
 
 
-def load(ctx, filename, callback=None):
+def load(ctx, filename, callback=None, cache=True, mapped=False):
     if os.path.isabs(filename):
         path = filename
     else:
@@ -885,11 +3805,43 @@ def load(ctx, filename, callback=None):
                 break
         else:
             raise FileNotFoundError(filename)
-    with open(path, "r", encoding=locale.getpreferredencoding()) as fp:
-        if callback:
-            parse(ctx, fp.read(), callback)
-        else:
-            execute(ctx, fp.read())
+    if callback is None:
+        callback = ctx.leval
+    encoding = locale.getpreferredencoding()
+    with open(path, "r", encoding=encoding) as fp:
+
+        def read(callback):
+            if not (mapped and parse_mapped(ctx, fp, callback, encoding)):
+                parse_file(ctx, fp, callback)
+
+        st = os.fstat(fp.fileno())
+        if not (
+            cache
+            and stat.S_ISREG(st.st_mode)
+            and st.st_size <= AST_CACHE_LIMIT
+        ):
+            ## pipes, huge files, and so on are just streamed
+            read(callback)
+            return
+        key = (
+            AST_CACHE_TAG,
+            os.path.abspath(path),
+            st.st_mtime_ns,
+            st.st_size,
+        )
+        forms = cache_read(path, AST_CACHE_SUFFIX, key)
+        if forms is None:
+            forms = []
+
+            def save(x):
+                forms.append(ast_encode(x))
+                callback(x)
+
+            read(save)
+            cache_write(path, AST_CACHE_SUFFIX, key, forms)
+            return
+    for x in forms:
+        callback(ast_decode(ctx, x))
 
 
 ## }}}
@@ -928,7 +3880,7 @@ def repl(ctx, callback):
     return rc
 
 
-def main(ctx=None, force_repl=False):
+def main(ctx=None, force_repl=False, cache=True, mapped=False):
     try:
         sys.set_int_max_str_digits(0)
     except AttributeError:
@@ -952,9 +3904,14 @@ def main(ctx=None, force_repl=False):
     stop = True
     for filename in sys.argv[1:]:
         if filename == "-":
-            stop = False
-            break
-        load(ctx, filename, callback=callback)
+            if sys.stdin.isatty():
+                stop = False
+                break
+            ## stream a pipe instead of reading it line by line
+            parse_file(ctx, sys.stdin, callback)
+            stop = True
+            continue
+        load(ctx, filename, callback=callback, cache=cache, mapped=mapped)
         stop = True
     try:
         if force_repl or not stop:
@@ -23,20 +23,40 @@
 ## pylint: disable=invalid-name, too-many-lines
 ## XXX pylint: disable=missing-docstring
 
+from collections import deque
+import operator
+import os
 import sys
 
 from lcore import (
     main as lmain,
+    Base,
     Context,
     EL,
+    Frame,
+    Profiler,
     SENTINEL,
+    Scope,
     Symbol,
     T,
+    cache_read,
+    cache_write,
     car,
     cdr,
+    cmpl,
+    compile_assign,
+    compile_attempt,
+    compile_call_steps,
+    compile_constant,
+    compile_define,
+    compile_direct,
+    compile_expr,
+    compile_lambda,
+    compile_seq2,
+    compile_sequence,
     cons,
     create_continuation,
-    create_lambda,
+    env_assign,
     eq,
     error,
     ffi,
@@ -44,11 +64,39 @@ from lcore import (
     is_atom,
     k_leval,
     k_stringify,
+    k_task_next,
+    k_task_run_all,
+    leaf,
     parse,
+    push_budget,
+    push_trap,
+    read_file,
+    scan_defines,
     set_car,
     set_cdr,
+    snapshot_dump,
+    snapshot_globals,
+    snapshot_key,
+    snapshot_load,
+    snapshot_maker,
     spcl,
     symcheck,
+    task_new,
+    task_queue,
+    task_switch,
+    task_wake,
+    trap_message,
+    vm_compile,
+    vm_compile_assign,
+    vm_compile_closure,
+    vm_compile_constant,
+    vm_compile_define,
+    vm_compile_if,
+    vm_compile_lambda,
+    vm_compile_let,
+    vm_compile_letrec,
+    vm_compile_sequence,
+    vmcmpl,
 )
 
 ## }}}
@@ -79,10 +127,127 @@ def binary(ctx, f):
     return ctx.cont
 
 
+def chain(ctx, f):
+    ## (op x y z ...) is true if (f x y) and (f y z) and ...
+    a = ctx.argl
+    try:
+        x, a = a
+    except TypeError:
+        raise SyntaxError("expected at least one arg") from None
+    while a is not EL:
+        y, a = a
+        if not f(x, y):
+            ctx.val = EL
+            return ctx.cont
+        x = y
+    ctx.val = T
+    return ctx.cont
+
+
+def intcheck(x):
+    if x.__class__ is int:
+        return x
+    raise TypeError(f"expected integer, got {x!r}")
+
+
+def form_items(args):
+    ## python list of the args of a special form
+    items = []
+    while args is not EL:
+        try:
+            x, args = args
+        except TypeError:
+            raise SyntaxError("expected list") from None
+        items.append(x)
+    return items
+
+
+def cond_clauses(ctx, args):
+    ## python list of (predicate, consequent) for cond
+    clauses = []
+    while args is not EL:
+        pc, args = args
+        try:
+            p, c = pc
+            if c.__class__ is not list:
+                raise TypeError()
+        except TypeError:
+            raise SyntaxError(f"expected list, got {pc!r}") from None
+        if c[1] is EL:
+            c = c[0]
+        else:
+            c = [ctx.symbol("begin"), c]
+        clauses.append((p, c))
+    return clauses
+
+
 ## }}}
 ## {{{ special forms
 
 
+@spcl("and")
+def op_and(ctx):
+    args = ctx.argl
+    if args is EL:
+        ctx.val = EL
+        return ctx.cont
+    ctx.s = [args, [ctx.env, [ctx.cont, ctx.s]]]
+    ctx.val = T
+    return op_and_next(ctx)
+
+
+def op_and_next(ctx):
+    args, s = ctx.s
+    if ctx.val is EL:
+        ctx.env, s = s
+        ctx.cont, ctx.s = s
+        return ctx.cont
+    try:
+        ctx.exp, args = args
+    except TypeError:
+        raise SyntaxError("expected list") from None
+    if args is EL:
+        ## last clause: tail position
+        ctx.env, s = s
+        ctx.cont, ctx.s = s
+    else:
+        ctx.env = s[0]
+        ctx.s = [args, s]
+        ctx.cont = op_and_next
+    return k_leval
+
+
+@cmpl(op_and)
+def c_and(ctx, args, scope):
+    items = form_items(args)
+    if not items:
+        return compile_constant(EL)
+    no = compile_constant(EL)
+    ret = compile_expr(ctx, items[-1], scope)
+    for x in reversed(items[:-1]):
+        ret = compile_if(compile_expr(ctx, x, scope), ret, no)
+    return ret
+
+
+@vmcmpl(op_and)
+def v_and(ctx, args, scope, linkage):
+    items = form_items(args)
+
+    def link(items, linkage):
+        if len(items) == 1:
+            return vm_compile(ctx, items[0], "val", linkage, scope)
+        return vm_compile_if(
+            vm_compile(ctx, items[0], "val", "next", scope),
+            lambda lk: link(items[1:], lk),
+            lambda lk: vm_compile_constant(EL, lk),
+            linkage,
+        )
+
+    if not items:
+        return vm_compile_constant(EL, linkage)
+    return link(items, linkage)
+
+
 @spcl("begin")
 @spcl("do")
 def op_begin(ctx):
@@ -133,6 +298,17 @@ def op_begin_next(ctx):
     return k_leval
 
 
+@cmpl(op_begin)
+def c_begin(ctx, args, scope):
+    items = form_items(args)
+    return compile_sequence(ctx, items, scope)
+
+
+@vmcmpl(op_begin)
+def v_begin(ctx, args, scope, linkage):
+    return vm_compile_sequence(ctx, form_items(args), scope, linkage)
+
+
 @spcl("cond")
 def op_cond(ctx):
     ctx.s = [ctx.env, [ctx.cont, ctx.s]]
@@ -175,6 +351,32 @@ def op_cond_next(ctx):
     return k_leval
 
 
+@cmpl(op_cond)
+def c_cond(ctx, args, scope):
+    ret = compile_constant(EL)
+    for p, c in reversed(cond_clauses(ctx, args)):
+        ret = compile_if(
+            compile_expr(ctx, p, scope), compile_expr(ctx, c, scope), ret
+        )
+    return ret
+
+
+@vmcmpl(op_cond)
+def v_cond(ctx, args, scope, linkage):
+    def link(clauses, linkage):
+        if not clauses:
+            return vm_compile_constant(EL, linkage)
+        (p, c), rest = clauses[0], clauses[1:]
+        return vm_compile_if(
+            vm_compile(ctx, p, "val", "next", scope),
+            lambda lk: vm_compile(ctx, c, "val", lk, scope),
+            lambda lk: link(rest, lk),
+            linkage,
+        )
+
+    return link(cond_clauses(ctx, args), linkage)
+
+
 @spcl("define")
 def op_define(ctx):
     try:
@@ -192,7 +394,10 @@ def op_define(ctx):
             body = body[0]
         else:
             body = [ctx.symbol("begin"), body]
-        ctx.env[sym] = create_lambda(params, body, ctx.env)
+        lam = ctx.lam(params, body, ctx.env)
+        if ctx.prof is not None:
+            lam = ctx.prof.wrap(sym, lam)
+        ctx.env[sym] = lam
         ctx.val = EL
         return ctx.cont
 
@@ -210,11 +415,111 @@ def k_op_define(ctx):
     sym, s = ctx.s
     ctx.env, s = s
     ctx.cont, ctx.s = s
+    if ctx.prof is not None:
+        ctx.val = ctx.prof.wrap(sym, ctx.val)
     ctx.env[sym] = ctx.val
     ctx.val = EL
     return ctx.cont
 
 
+@cmpl(op_define)
+def c_define(ctx, args, scope):
+    try:
+        sym, body = args
+        if body is EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("define takes at least 2 args") from None
+
+    if sym.__class__ is list:
+        sym, params = sym
+        if sym.__class__ is not Symbol:
+            raise SyntaxError("expected symbol")
+        if body[1] is EL:
+            body = body[0]
+        else:
+            body = [ctx.symbol("begin"), body]
+        make = compile_lambda(ctx, params, body, scope)
+        define = compile_define(sym, scope)
+
+        def direct(ctx):
+            define(ctx, make(ctx.env))
+            return EL
+
+        return compile_direct(direct)
+
+    if body[1] is not EL:
+        raise SyntaxError("body must be a single value")
+    if sym.__class__ is not Symbol:
+        raise SyntaxError("expected symbol")
+    define = compile_define(sym, scope)
+    return compile_define_value(ctx, define, body[0], scope)
+
+
+@vmcmpl(op_define)
+def v_define(ctx, args, scope, linkage):
+    try:
+        sym, body = args
+        if body is EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("define takes at least 2 args") from None
+
+    if sym.__class__ is list:
+        sym, params = sym
+        if sym.__class__ is not Symbol:
+            raise SyntaxError("expected symbol")
+        if body[1] is EL:
+            body = body[0]
+        else:
+            body = [ctx.symbol("begin"), body]
+        make = vm_compile_lambda(ctx, params, body, scope)
+        value = vm_compile_closure(make, "next")
+    else:
+        if body[1] is not EL:
+            raise SyntaxError("body must be a single value")
+        if sym.__class__ is not Symbol:
+            raise SyntaxError("expected symbol")
+        value = vm_compile(ctx, body[0], "val", "next", scope)
+    return vm_compile_define(sym, value, linkage)
+
+
+def compile_define_value(ctx, define, x, scope):
+    ## evaluate x and hand it to define(ctx, value); the node's value is ()
+    vc = compile_expr(ctx, x, scope)
+    node, vd = vc
+    if vd is not None:
+
+        def direct(ctx):
+            define(ctx, vd(ctx))
+            return EL
+
+        return compile_direct(direct)
+
+    va = compile_attempt(vc)
+
+    def k_define(ctx):
+        ctx.env, s = ctx.s
+        ctx.cont, ctx.s = s
+        define(ctx, ctx.val)
+        ctx.val = EL
+        return ctx.cont
+
+    def c_define_node(ctx):
+        if va is not None:
+            x = va(ctx)
+            if x is not SENTINEL:
+                define(ctx, x)
+                ctx.val = EL
+                return ctx.cont
+        ctx.s = [ctx.env, [ctx.cont, ctx.s]]
+        ctx.cont = k_define
+        r = node(ctx)
+        return k_define(ctx) if r is k_define else r
+
+    return c_define_node, None
+
+
 ## optimized (if)
 
 
@@ -241,6 +546,78 @@ def k_op_if(ctx):
     return k_leval
 
 
+@cmpl(op_if)
+def c_if(ctx, args, scope):
+    try:
+        x, rest = args
+        c, rest = rest
+        a, rest = rest
+        if rest is not EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected three args") from None
+    return compile_if(
+        compile_expr(ctx, x, scope),
+        compile_expr(ctx, c, scope),
+        compile_expr(ctx, a, scope),
+    )
+
+
+@vmcmpl(op_if)
+def v_if(ctx, args, scope, linkage):
+    try:
+        x, rest = args
+        c, rest = rest
+        a, rest = rest
+        if rest is not EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected three args") from None
+    return vm_compile_if(
+        vm_compile(ctx, x, "val", "next", scope),
+        lambda lk: vm_compile(ctx, c, "val", lk, scope),
+        lambda lk: vm_compile(ctx, a, "val", lk, scope),
+        linkage,
+    )
+
+
+def compile_if(test, conseq, alt):
+    tn, td = test
+    cn, cd = conseq
+    an, ad = alt
+    if td is not None:
+
+        def node(ctx):
+            return an(ctx) if td(ctx) is EL else cn(ctx)
+
+        if cd is None or ad is None:
+            return node, None
+
+        def direct(ctx):
+            return ad(ctx) if td(ctx) is EL else cd(ctx)
+
+        return node, direct
+
+    ta = compile_attempt(test)
+
+    def k_if(ctx):
+        ctx.env, s = ctx.s
+        ctx.cont, ctx.s = s
+        return an(ctx) if ctx.val is EL else cn(ctx)
+
+    def node(ctx):  ## pylint: disable=function-redefined
+        if ta is not None:
+            x = ta(ctx)
+            if x is not SENTINEL:
+                return an(ctx) if x is EL else cn(ctx)
+        ctx.s = [ctx.env, [ctx.cont, ctx.s]]
+        ctx.cont = k_if
+        r = tn(ctx)
+        return k_if(ctx) if r is k_if else r
+
+    return node, None
+
+
 @spcl("lambda")
 def op_lambda(ctx):
     try:
@@ -253,16 +630,388 @@ def op_lambda(ctx):
         body = car(body)
     else:
         body = cons(ctx.symbol("begin"), body)
-    ctx.val = create_lambda(params, body, ctx.env)
+    ctx.val = ctx.lam(params, body, ctx.env)
     return ctx.cont
 
 
+@cmpl(op_lambda)
+def c_lambda(ctx, args, scope):
+    try:
+        params, body = args
+        if body.__class__ is not list:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected at least 2 args") from None
+    if body[1] is EL:
+        body = body[0]
+    else:
+        body = [ctx.symbol("begin"), body]
+    make = compile_lambda(ctx, params, body, scope)
+
+    def direct(ctx):
+        return make(ctx.env)
+
+    return compile_direct(direct)
+
+
+@vmcmpl(op_lambda)
+def v_lambda(ctx, args, scope, linkage):
+    try:
+        params, body = args
+        if body.__class__ is not list:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected at least 2 args") from None
+    if body[1] is EL:
+        body = body[0]
+    else:
+        body = [ctx.symbol("begin"), body]
+    make = vm_compile_lambda(ctx, params, body, scope)
+    return vm_compile_closure(make, linkage)
+
+
+## native let forms
+
+
+def let_args(ctx, args):
+    ## (bindings, body) with a multi-form body wrapped in begin
+    try:
+        vdefs, body = args
+        if body.__class__ is not list:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected at least 2 args") from None
+    if body[1] is EL:
+        return vdefs, body[0]
+    return vdefs, [ctx.symbol("begin"), body]
+
+
+def let_binding(vdefs):
+    ## (sym, expr, rest) for the first (sym expr) in vdefs
+    try:
+        vdef, rest = vdefs
+        sym, x = vdef
+        x, a = x
+        if a is not EL:
+            raise TypeError()
+    except (TypeError, ValueError):
+        raise SyntaxError(f"expected (symbol value), got {vdefs!r}") from None
+    if sym.__class__ is not Symbol:
+        raise SyntaxError(f"expected symbol, got {sym!r}")
+    return sym, x, rest
+
+
+@spcl("let")
+def op_let(ctx):
+    vdefs, body = let_args(ctx, ctx.argl)
+    ctx.s = [ctx.env, [ctx.cont, ctx.s]]
+    return op_let_setup(ctx, vdefs, EL, body)
+
+
+def op_let_setup(ctx, vdefs, bound, body):
+    ## bound is a lisp list of (sym, value) so re-entry via call/cc is safe
+    if vdefs is EL:
+        env, s = ctx.s
+        ctx.cont, ctx.s = s
+        e = {SENTINEL: env}
+        while bound is not EL:
+            (sym, x), bound = bound
+            if sym not in e:
+                e[sym] = x
+        ctx.env = e
+        ctx.exp = body
+        return k_leval
+    sym, ctx.exp, vdefs = let_binding(vdefs)
+    ctx.env = ctx.s[0]
+    ctx.s = [(vdefs, sym, bound, body), ctx.s]
+    ctx.cont = k_op_let
+    return k_leval
+
+
+def k_op_let(ctx):
+    (vdefs, sym, bound, body), ctx.s = ctx.s
+    return op_let_setup(ctx, vdefs, [(sym, ctx.val), bound], body)
+
+
+@spcl("let*")
+def op_letstar(ctx):
+    vdefs, body = let_args(ctx, ctx.argl)
+    ctx.s = [ctx.env, [ctx.cont, ctx.s]]
+    return op_letstar_setup(ctx, vdefs, body)
+
+
+def op_letstar_setup(ctx, vdefs, body):
+    ## the env on top of the stack grows by one frame per binding
+    if vdefs is EL:
+        ctx.env, s = ctx.s
+        ctx.cont, ctx.s = s
+        ctx.exp = body
+        return k_leval
+    sym, ctx.exp, vdefs = let_binding(vdefs)
+    ctx.env = ctx.s[0]
+    ctx.s = [(vdefs, sym, body), ctx.s]
+    ctx.cont = k_op_letstar
+    return k_leval
+
+
+def k_op_letstar(ctx):
+    (vdefs, sym, body), s = ctx.s
+    env, s = s
+    ctx.s = [{SENTINEL: env, sym: ctx.val}, s]
+    return op_letstar_setup(ctx, vdefs, body)
+
+
+@spcl("letrec")
+def op_letrec(ctx):
+    vdefs, body = let_args(ctx, ctx.argl)
+    e = {SENTINEL: ctx.env}
+    x = vdefs
+    while x is not EL:
+        sym, _, x = let_binding(x)
+        e[sym] = EL
+    ctx.env = e
+    ctx.s = [ctx.cont, ctx.s]
+    return op_letrec_setup(ctx, vdefs, body)
+
+
+def op_letrec_setup(ctx, vdefs, body):
+    if vdefs is EL:
+        ctx.cont, ctx.s = ctx.s
+        ctx.exp = body
+        return k_leval
+    sym, ctx.exp, vdefs = let_binding(vdefs)
+    ctx.s = [(vdefs, sym, body), [ctx.env, ctx.s]]
+    ctx.cont = k_op_letrec
+    return k_leval
+
+
+def k_op_letrec(ctx):
+    (vdefs, sym, body), s = ctx.s
+    ctx.env, ctx.s = s
+    ctx.env[sym] = ctx.val
+    return op_letrec_setup(ctx, vdefs, body)
+
+
+def c_let_bindings(args):
+    syms, exprs = [], []
+    while args is not EL:
+        sym, x, args = let_binding(args)
+        syms.append(sym)
+        exprs.append(x)
+    return syms, exprs
+
+
+@cmpl(op_let)
+def c_let(ctx, args, scope):
+    vdefs, body = let_args(ctx, args)
+    syms, exprs = c_let_bindings(vdefs)
+    return compile_let(ctx, syms, exprs, body, scope)
+
+
+@vmcmpl(op_let)
+def v_let(ctx, args, scope, linkage):
+    vdefs, body = let_args(ctx, args)
+    syms, exprs = c_let_bindings(vdefs)
+    return vm_compile_let(ctx, syms, exprs, body, scope, linkage)
+
+
+@cmpl(op_letstar)
+def c_letstar(ctx, args, scope):
+    vdefs, body = let_args(ctx, args)
+    syms, exprs = c_let_bindings(vdefs)
+    if not syms:
+        return compile_expr(ctx, body, scope)
+    return compile_let(ctx, syms, exprs, body, scope, True)
+
+
+@vmcmpl(op_letstar)
+def v_letstar(ctx, args, scope, linkage):
+    vdefs, body = let_args(ctx, args)
+    syms, exprs = c_let_bindings(vdefs)
+    if not syms:
+        return vm_compile(ctx, body, "val", linkage, scope)
+    return vm_compile_let(ctx, syms, exprs, body, scope, linkage, True)
+
+
+def compile_let(ctx, syms, exprs, body, scope, star=False):
+    ## pylint: disable=too-many-arguments, too-many-locals
+    ## pylint: disable=too-many-positional-arguments
+    ## let* is a chain of one-binding lets; the innermost one owns the
+    ## slots for names defined in the body
+    if star and len(syms) > 1:
+        syms, exprs, rest = syms[:1], exprs[:1], (syms[1:], exprs[1:])
+    else:
+        rest = None
+    n = len(syms)
+    names = {}
+    for i, sym in enumerate(syms):
+        names[sym] = i
+    nslots = n
+    if rest is None:
+        for sym in scan_defines(ctx, body, {}):
+            if sym not in names:
+                names[sym] = nslots
+                nslots += 1
+    pad = [SENTINEL] * (nslots - n)
+    inner = Scope(names, scope, scope.env)
+    if rest is None:
+        bn, bd = compile_expr(ctx, body, inner)
+    else:
+        bn, bd = compile_let(ctx, rest[0], rest[1], body, inner, True)
+    vcs = [compile_expr(ctx, x, scope) for x in exprs]
+    directs = [d for _, d in vcs]
+
+    if None not in directs:
+
+        def node(ctx):
+            ctx.env = Frame([d(ctx) for d in directs] + pad, ctx.env, names)
+            return bn(ctx)
+
+        if bd is None:
+            return node, None
+
+        def direct(ctx):
+            env = ctx.env
+            ctx.env = Frame([d(ctx) for d in directs] + pad, env, names)
+            x = bd(ctx)
+            ctx.env = env
+            return x
+
+        return node, direct
+
+    def finish(ctx, _, acc):
+        ctx.env = Frame([*acc, *pad], ctx.env, names)
+        return bn(ctx)
+
+    step = compile_call_steps(vcs, finish)[0]
+
+    def node(ctx):  ## pylint: disable=function-redefined
+        return step(ctx, None, ())
+
+    return node, None
+
+
+@cmpl(op_letrec)
+def c_letrec(ctx, args, scope):
+    ## pylint: disable=too-many-locals
+    vdefs, body = let_args(ctx, args)
+    syms, exprs = c_let_bindings(vdefs)
+    names = {}
+    for sym in syms:
+        if sym not in names:
+            names[sym] = len(names)
+    n = len(names)
+    scan_defines(ctx, body, names)
+    init = [EL] * n + [SENTINEL] * (len(names) - n)
+    inner = Scope(names, scope, scope.env)
+    ret = compile_expr(ctx, body, inner)
+    for sym, x in reversed(list(zip(syms, exprs))):
+        define = compile_define(sym, inner)
+        ret = compile_seq2(compile_define_value(ctx, define, x, inner), ret)
+    rn, rd = ret
+
+    def node(ctx):
+        ctx.env = Frame(init[:], ctx.env, names)
+        return rn(ctx)
+
+    if rd is None:
+        return node, None
+
+    def direct(ctx):
+        env = ctx.env
+        ctx.env = Frame(init[:], env, names)
+        x = rd(ctx)
+        ctx.env = env
+        return x
+
+    return node, direct
+
+
+@vmcmpl(op_letrec)
+def v_letrec(ctx, args, scope, linkage):
+    vdefs, body = let_args(ctx, args)
+    syms, exprs = c_let_bindings(vdefs)
+    return vm_compile_letrec(ctx, syms, exprs, body, scope, linkage)
+
+
+@spcl("or")
+def op_or(ctx):
+    ctx.s = [ctx.argl, [ctx.env, [ctx.cont, ctx.s]]]
+    ctx.val = EL
+    return op_or_next(ctx)
+
+
+def op_or_next(ctx):
+    ## like the old runtime version, the value is #t rather than the
+    ## clause value so the last clause is not in tail position
+    args, s = ctx.s
+    if ctx.val is not EL or args is EL:
+        ctx.env, s = s
+        ctx.cont, ctx.s = s
+        ctx.val = EL if ctx.val is EL else T
+        return ctx.cont
+    try:
+        ctx.exp, args = args
+    except TypeError:
+        raise SyntaxError("expected list") from None
+    ctx.env = s[0]
+    ctx.s = [args, s]
+    ctx.cont = op_or_next
+    return k_leval
+
+
+@cmpl(op_or)
+def c_or(ctx, args, scope):
+    items = form_items(args)
+    ret = compile_constant(EL)
+    for x in reversed(items):
+        ret = compile_if(compile_expr(ctx, x, scope), compile_constant(T), ret)
+    return ret
+
+
+@vmcmpl(op_or)
+def v_or(ctx, args, scope, linkage):
+    def link(items, linkage):
+        if not items:
+            return vm_compile_constant(EL, linkage)
+        return vm_compile_if(
+            vm_compile(ctx, items[0], "val", "next", scope),
+            lambda lk: vm_compile_constant(T, lk),
+            lambda lk: link(items[1:], lk),
+            linkage,
+        )
+
+    return link(form_items(args), linkage)
+
+
 @spcl("quote")
 def op_quote(ctx):
     ctx.val = ctx.unpack1()
     return ctx.cont
 
 
+@cmpl(op_quote)
+def c_quote(_, args, __):
+    try:
+        x, a = args
+        if a is not EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected one arg") from None
+    return compile_constant(x)
+
+
+@vmcmpl(op_quote)
+def v_quote(_, args, __, linkage):
+    try:
+        x, a = args
+        if a is not EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected one arg") from None
+    return vm_compile_constant(x, linkage)
+
+
 @spcl("set!")
 def op_setbang(ctx):
     try:
@@ -284,14 +1033,73 @@ def k_op_setbang(ctx):
     ctx.env, s = ctx.s
     ctx.cont, s = s
     sym, ctx.s = s
-    e = ctx.env
-    while e is not SENTINEL:
-        if sym in e:
-            e[sym] = ctx.val
-            ctx.val = EL
-            return ctx.cont
-        e = e[SENTINEL]
-    raise NameError(str(sym))
+    env_assign(ctx.env, sym, ctx.val)
+    ctx.val = EL
+    return ctx.cont
+
+
+@cmpl(op_setbang)
+def c_setbang(ctx, args, scope):
+    try:
+        sym, a = args
+        value, a = a
+        if a is not EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected two args") from None
+    if sym.__class__ is not Symbol:
+        raise SyntaxError("expected symbol")
+
+    assign = compile_assign(sym, scope)
+
+    def setbang(ctx, value):
+        assign(ctx, value)
+        return EL
+
+    vc = compile_expr(ctx, value, scope)
+    node, vd = vc
+    if vd is not None:
+
+        def direct(ctx):
+            return setbang(ctx, vd(ctx))
+
+        return compile_direct(direct)
+
+    va = compile_attempt(vc)
+
+    def k_setbang(ctx):
+        ctx.env, s = ctx.s
+        ctx.cont, ctx.s = s
+        ctx.val = setbang(ctx, ctx.val)
+        return ctx.cont
+
+    def c_setbang_node(ctx):
+        if va is not None:
+            x = va(ctx)
+            if x is not SENTINEL:
+                ctx.val = setbang(ctx, x)
+                return ctx.cont
+        ctx.s = [ctx.env, [ctx.cont, ctx.s]]
+        ctx.cont = k_setbang
+        r = node(ctx)
+        return k_setbang(ctx) if r is k_setbang else r
+
+    return c_setbang_node, None
+
+
+@vmcmpl(op_setbang)
+def v_setbang(ctx, args, scope, linkage):
+    try:
+        sym, a = args
+        value, a = a
+        if a is not EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected two args") from None
+    if sym.__class__ is not Symbol:
+        raise SyntaxError("expected symbol")
+    value = vm_compile(ctx, value, "val", "next", scope)
+    return vm_compile_assign(sym, value, linkage)
 
 
 @spcl("special")
@@ -309,7 +1117,7 @@ def op_special(ctx):
             body = car(body)
         else:
             body = cons(ctx.symbol("begin"), body)
-        lam = create_lambda(params, body, ctx.env)
+        lam = ctx.lam(params, body, ctx.env)
         lam.special = True
         ctx.env[symcheck(sym)] = lam
         ctx.val = EL
@@ -331,6 +1139,7 @@ def k_op_special(ctx):
     if not callable(proc):
         raise SyntaxError("expected proc")
     proc.special = True
+    proc.leaf = False
     ctx.env[sym] = proc
     ctx.val = EL
     return ctx.cont
@@ -338,18 +1147,20 @@ def k_op_special(ctx):
 
 @spcl("trap")
 def op_trap(ctx):
-    x = ctx.unpack1()
-    ok = T
-    ctx.push_ce()
-    try:
-        res = ctx.leval(x, ctx.env)
-    except:  ## pylint: disable=bare-except
-        ok = EL
-        t, v = sys.exc_info()[:2]
-        res = f"{t.__name__}: {str(v)}"
-    ctx.pop_ce()
-    ctx.val = cons(ok, cons(res, EL))
-    return ctx.cont
+    ## (#t value) or, if x raises, (() "Type: message"). the handler is
+    ## a frame on ctx.s, so this doesn't nest trampolines
+    ctx.exp = ctx.unpack1()
+    push_trap(ctx)
+    return k_leval
+
+
+@spcl("trap-exception")
+def op_trap_exception(ctx):
+    ## like trap but hands over the exception object, see
+    ## exception-message
+    ctx.exp = ctx.unpack1()
+    push_trap(ctx, True)
+    return k_leval
 
 
 ## }}}
@@ -446,6 +1257,22 @@ def k_qq_finish(ctx):
 ## {{{ primitives
 
 
+@leaf
+@glbl("add")
+@glbl("+")
+def op_add(ctx):
+    a = ctx.argl
+    if a is EL:
+        ctx.val = 0
+        return ctx.cont
+    x, a = a
+    while a is not EL:
+        y, a = a
+        x = x + y
+    ctx.val = x
+    return ctx.cont
+
+
 @glbl("apply")
 def op_apply(ctx):
     proc, ctx.argl = ctx.unpack2()
@@ -456,6 +1283,20 @@ def op_apply(ctx):
     return proc
 
 
+@leaf
+@glbl("arithmetic-shift")
+def op_arithmetic_shift(ctx):
+    ## shift left by n, or right if n is negative
+    x, n = ctx.unpack2()
+    intcheck(x)
+    if intcheck(n) < 0:
+        ctx.val = x >> -n
+    else:
+        ctx.val = x << n
+    return ctx.cont
+
+
+@leaf
 @glbl("atom?")
 def op_atom(ctx):
     ## you could change op_atom_f to a lambda and save a global
@@ -469,6 +1310,64 @@ def op_atom_f(x):
     return T if is_atom(x) else EL
 
 
+@leaf
+@glbl("bit-and")
+@glbl("band")
+def op_bit_and(ctx):
+    a = ctx.argl
+    x = -1
+    while a is not EL:
+        y, a = a
+        x &= intcheck(y)
+    ctx.val = x
+    return ctx.cont
+
+
+@leaf
+@glbl("bit-count")
+def op_bit_count(ctx):
+    ## number of 1 bits, or of 0 bits if x is negative
+    x = intcheck(ctx.unpack1())
+    if x < 0:
+        x = ~x
+    ctx.val = bin(x).count("1")
+    return ctx.cont
+
+
+@leaf
+@glbl("bit-not")
+@glbl("bnot")
+def op_bit_not(ctx):
+    ctx.val = ~intcheck(ctx.unpack1())
+    return ctx.cont
+
+
+@leaf
+@glbl("bit-or")
+@glbl("bor")
+def op_bit_or(ctx):
+    a = ctx.argl
+    x = 0
+    while a is not EL:
+        y, a = a
+        x |= intcheck(y)
+    ctx.val = x
+    return ctx.cont
+
+
+@leaf
+@glbl("bit-xor")
+@glbl("bxor")
+def op_bit_xor(ctx):
+    a = ctx.argl
+    x = 0
+    while a is not EL:
+        y, a = a
+        x ^= intcheck(y)
+    ctx.val = x
+    return ctx.cont
+
+
 @glbl("call/cc")
 @glbl("call-with-current-continuation")
 def op_callcc(ctx):
@@ -497,25 +1396,41 @@ def op_callcc(ctx):
     return proc
 
 
+@leaf
 @glbl("car")
 def op_car(ctx):
     return unary(ctx, car)
 
 
+@leaf
 @glbl("cdr")
 def op_cdr(ctx):
     return unary(ctx, cdr)
 
 
+@leaf
 @glbl("cons")
 def op_cons(ctx):
     return binary(ctx, cons)
 
 
+@leaf
 @glbl("/")
 @glbl("div")
 def op_div(ctx):
-    return binary(ctx, op_div_f)
+    a = ctx.argl
+    try:
+        x, a = a
+    except TypeError:
+        raise SyntaxError("expected at least one arg") from None
+    if a is EL:
+        ctx.val = op_div_f(1, x)
+        return ctx.cont
+    while a is not EL:
+        y, a = a
+        x = op_div_f(x, y)
+    ctx.val = x
+    return ctx.cont
 
 
 def op_div_f(x, y):
@@ -524,6 +1439,7 @@ def op_div_f(x, y):
     return x / y
 
 
+@leaf
 @glbl("eq?")
 def op_eq(ctx):
     return binary(ctx, op_eq_f)
@@ -533,6 +1449,7 @@ def op_eq_f(x, y):
     return T if eq(x, y) else EL
 
 
+@leaf
 @glbl("equal?")
 def op_equal(ctx):
     return binary(ctx, op_equal_f)
@@ -568,6 +1485,17 @@ def op_eval(ctx):
     return k_leval
 
 
+@leaf
+@glbl("exception-message")
+def op_exception_message(ctx):
+    ## "Type: message" for an exception from trap-exception
+    x = ctx.unpack1()
+    if not isinstance(x, BaseException):
+        raise TypeError(f"expected exception, got {x!r}")
+    ctx.val = trap_message(x)
+    return ctx.cont
+
+
 @glbl("exit")
 def op_exit(ctx):
     x = ctx.unpack1()
@@ -582,26 +1510,74 @@ def k_op_exit(ctx):
     raise SystemExit(ctx.val)
 
 
+@leaf
+@glbl(">=")
+def op_ge(ctx):
+    return chain(ctx, operator.ge)
+
+
+@leaf
+@glbl(">")
+def op_gt(ctx):
+    return chain(ctx, operator.gt)
+
+
+@leaf
+@glbl("<=")
+def op_le(ctx):
+    return chain(ctx, operator.le)
+
+
+@leaf
+@glbl("lshift")
+def op_lshift(ctx):
+    x, n = ctx.unpack2()
+    ctx.val = intcheck(x) << intcheck(n)
+    return ctx.cont
+
+
+@leaf
 @glbl("lt?")
 @glbl("<")
 def op_lt(ctx):
-    return binary(ctx, op_lt_f)
+    return chain(ctx, operator.lt)
 
 
-def op_lt_f(x, y):
-    return T if x < y else EL
+@leaf
+@glbl("%")
+def op_mod(ctx):
+    a = ctx.argl
+    try:
+        x, a = a
+        if a is EL:
+            raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected at least two args") from None
+    while a is not EL:
+        y, a = a
+        ## same as the old (- n (* d (/ n d)))
+        x = x - y * op_div_f(x, y)
+    ctx.val = x
+    return ctx.cont
 
 
+@leaf
 @glbl("mul")
 @glbl("*")
 def op_mul(ctx):
-    return binary(ctx, op_mul_f)
-
-
-def op_mul_f(x, y):
-    return x * y
+    a = ctx.argl
+    if a is EL:
+        ctx.val = 1
+        return ctx.cont
+    x, a = a
+    while a is not EL:
+        y, a = a
+        x = x * y
+    ctx.val = x
+    return ctx.cont
 
 
+@leaf
 @glbl("nand")
 def op_nand(ctx):
     return binary(ctx, op_nand_f)
@@ -613,6 +1589,13 @@ def op_nand_f(x, y):
     return ~(x & y)
 
 
+@leaf
+@glbl("!=")
+def op_ne(ctx):
+    return chain(ctx, operator.ne)
+
+
+@leaf
 @glbl("null?")
 def op_null(ctx):
     x = ctx.unpack1()
@@ -662,6 +1645,7 @@ def k_op_print(ctx):
     return k_stringify
 
 
+@leaf
 @glbl("range")  ## this is a prim because ffi is too slow for large lists
 def op_range(ctx):
     start, stop, step = ctx.unpack3()
@@ -672,33 +1656,78 @@ def op_range(ctx):
     return ctx.cont
 
 
+@leaf
+@glbl("read-file")
+def op_read_file(ctx):
+    ## list of the forms in a file, read through mmap if possible
+    path = ctx.unpack1()
+    if path.__class__ is not str:
+        raise TypeError(f"expected string, got {path!r}")
+    ret = EL
+    for x in reversed(read_file(ctx, path)):
+        ret = [x, ret]
+    ctx.val = ret
+    return ctx.cont
+
+
+@leaf
+@glbl("rshift")
+def op_rshift(ctx):
+    x, n = ctx.unpack2()
+    ctx.val = intcheck(x) >> intcheck(n)
+    return ctx.cont
+
+
+@leaf
 @glbl("set-car!")
 def op_setcar(ctx):
     return binary(ctx, set_car)
 
 
+@leaf
 @glbl("set-cdr!")
 def op_setcdr(ctx):
     return binary(ctx, set_cdr)
 
 
+@leaf
+@glbl("stats")
+def op_stats(ctx):
+    ## trampoline counters as a hash, () unless instrumented
+    if ctx.argl is not EL:
+        raise SyntaxError("expected no args")
+    st = ctx.stats()
+    if st is None:
+        ctx.val = EL
+        return ctx.cont
+    ret = Hash(st)
+    ret["last"] = hash_list(st["last"])
+    ret["counts"] = Hash(st["counts"])
+    ret["hist"] = Hash(st["hist"])
+    ctx.val = ret
+    return ctx.cont
+
+
+@leaf
 @glbl("sub")
 @glbl("-")
 def op_sub(ctx):
-    try:
-        x, a = ctx.argl
-        if a is EL:
-            x, y = 0, x
-        else:
-            y, a = a
-            if a is not EL:
-                raise TypeError()
+    a = ctx.argl
+    try:
+        x, a = a
     except TypeError:
-        raise SyntaxError("expected one or two args") from None
-    ctx.val = x - y
+        raise SyntaxError("expected at least one arg") from None
+    if a is EL:
+        ctx.val = -x
+        return ctx.cont
+    while a is not EL:
+        y, a = a
+        x = x - y
+    ctx.val = x
     return ctx.cont
 
 
+@leaf
 @glbl("type")
 def op_type(ctx):
     def f(x):
@@ -717,6 +1746,10 @@ def op_type(ctx):
             return ctx.symbol("float")
         if isinstance(x, str):
             return ctx.symbol("string")
+        if isinstance(x, Hash):
+            return ctx.symbol("hash")
+        if isinstance(x, Chan):
+            return ctx.symbol("chan")
         if getattr(x, "lambda_", None):
             return ctx.symbol("lambda")
         if getattr(x, "continuation", False):
@@ -759,6 +1792,436 @@ def k_op_while(ctx):
     return x
 
 
+@glbl("with-budget")
+def op_with_budget(ctx):
+    ## (with-budget steps thunk [seconds]) is (#t value) if (thunk)
+    ## returns within steps bounces and seconds, else like trap gives
+    ## (() "BudgetExceeded: ..."). steps () means no step limit. only
+    ## this catches it, not trap
+    a = ctx.argl
+    try:
+        steps, a = a
+        proc, a = a
+        if a is EL:
+            seconds = None
+        else:
+            seconds, a = a
+            if a is not EL:
+                raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected two or three args") from None
+    if steps is EL:
+        steps = None
+    elif steps.__class__ is not int or steps < 0:
+        raise TypeError(f"expected steps >= 0, got {steps!r}")
+    if seconds is not None and not isinstance(seconds, (int, float)):
+        raise TypeError(f"expected seconds, got {seconds!r}")
+    if getattr(proc, "special", True):
+        raise TypeError(f"expected procedure, got {proc!r}")
+    return push_budget(ctx, proc, steps, seconds)
+
+
+## }}}
+## {{{ hash tables
+
+
+class Hash(dict):
+    ## pylint: disable=too-few-public-methods
+    __slots__ = ()
+
+    def snapshot_(self):
+        ## see snapshot_dump() in lcore.py
+        return "hash", hash_items(self)
+
+
+@snapshot_maker("hash")
+def snapshot_hash(_):
+    h = Hash()
+
+    def fill(items):
+        while items is not EL:
+            (k, (v, _)), items = items
+            h[keycheck(k)] = v
+
+    return h, fill
+
+
+def hashcheck(x):
+    if x.__class__ is Hash:
+        return x
+    raise TypeError(f"expected hash, got {x!r}")
+
+
+## #t is python's True, which is the same dict key as 1 and 1.0. so
+## it is stored as TKEY instead, and turned back by unkey()
+TKEY = (bool, True)
+
+
+def keycheck(x):
+    if x is T:
+        return TKEY
+    t = x.__class__
+    if t is list or t is Hash:
+        raise TypeError(f"expected atom, number, or string, got {x!r}")
+    return x
+
+
+def unkey(k):
+    return T if k is TKEY else k
+
+
+def hash_items(h):
+    ret = EL
+    for k, v in reversed(h.items()):
+        ret = [[unkey(k), [v, EL]], ret]
+    return ret
+
+
+def hash_list(xs):
+    ret = EL
+    for x in reversed(xs):
+        ret = [x, ret]
+    return ret
+
+
+@leaf
+@glbl("hash-count")
+def op_hash_count(ctx):
+    ctx.val = len(hashcheck(ctx.unpack1()))
+    return ctx.cont
+
+
+@leaf
+@glbl("hash-del!")
+def op_hash_del(ctx):
+    h, k = ctx.unpack2()
+    hashcheck(h).pop(keycheck(k), None)
+    ctx.val = EL
+    return ctx.cont
+
+
+@leaf
+@glbl("hash-has?")
+def op_hash_has(ctx):
+    h, k = ctx.unpack2()
+    ctx.val = T if keycheck(k) in hashcheck(h) else EL
+    return ctx.cont
+
+
+@leaf
+@glbl("hash-items")
+def op_hash_items(ctx):
+    ctx.val = hash_items(hashcheck(ctx.unpack1()))
+    return ctx.cont
+
+
+@leaf
+@glbl("hash-keys")
+def op_hash_keys(ctx):
+    ctx.val = hash_list([unkey(k) for k in hashcheck(ctx.unpack1())])
+    return ctx.cont
+
+
+@leaf
+@glbl("hash-ref")
+def op_hash_ref(ctx):
+    a = ctx.argl
+    try:
+        h, a = a
+        k, a = a
+        if a is EL:
+            d = EL
+        else:
+            d, a = a
+            if a is not EL:
+                raise TypeError()
+    except TypeError:
+        raise SyntaxError("expected two or three args") from None
+    ctx.val = hashcheck(h).get(keycheck(k), d)
+    return ctx.cont
+
+
+@leaf
+@glbl("hash-set!")
+def op_hash_set(ctx):
+    h, k, v = ctx.unpack3()
+    hashcheck(h)[keycheck(k)] = v
+    ctx.val = EL
+    return ctx.cont
+
+
+@leaf
+@glbl("hash-values")
+def op_hash_values(ctx):
+    ctx.val = hash_list(list(hashcheck(ctx.unpack1()).values()))
+    return ctx.cont
+
+
+@leaf
+@glbl("make-hash")
+def op_make_hash(ctx):
+    if ctx.argl is not EL:
+        raise SyntaxError("expected no args")
+    ctx.val = Hash()
+    return ctx.cont
+
+
+class Box:
+    ## pylint: disable=too-few-public-methods
+    ## a table$hash key that can't be hashed itself
+    __slots__ = ("x",)
+
+    def __init__(self, x):
+        self.x = x
+
+
+@leaf
+@glbl("table$hash")
+def op_table_hash(ctx):
+    ## native (table eq?) and (table equal?): the message interface of
+    ## the runtime table with a Hash behind it. items are reported
+    ## newest first like the assoc list version. keys that can't be
+    ## hashed go in Boxes, found by a linear scan with compare.
+    ctx.val = table_hash(ctx, ctx.unpack1())[0]
+    return ctx.cont
+
+
+@snapshot_maker("table$eq?")
+def snapshot_table_eq(ctx):
+    return table_hash(ctx, op_eq)
+
+
+@snapshot_maker("table$equal?")
+def snapshot_table_equal(ctx):
+    return table_hash(ctx, op_equal)
+
+
+def table_hash(ctx, compare):
+    ## pylint: disable=too-many-locals
+    ## a new table for op_table_hash() and a function that fills it from
+    ## a snapshot
+    same = eq if compare is op_eq else op_equal_f
+    h = Hash()
+    boxes = []
+
+    def key(k, add=False):
+        ## the dict key for k, None if k is unhashable and not there
+        if k is T:
+            return TKEY
+        t = k.__class__
+        if t is not list and t is not Hash:
+            return k
+        for b in boxes:
+            if same(b.x, k):
+                return b
+        if not add:
+            return None
+        b = Box(k)
+        boxes.append(b)
+        return b
+
+    def unbox(k):
+        return k.x if k.__class__ is Box else unkey(k)
+
+    def m_known(args):
+        return T if key(car(args)) in h else EL
+
+    def m_del(args):
+        k = key(car(args))
+        h.pop(k, None)
+        if k.__class__ is Box:
+            boxes.remove(k)
+        return EL
+
+    def m_get(args):
+        return h.get(key(car(args)), EL)
+
+    def m_iter(_):
+        items = iter(reversed([[unbox(k), [v, EL]] for k, v in h.items()]))
+
+        def it(ctx):
+            ctx.val = next(items, EL)
+            return ctx.cont
+
+        it.special = it.ffi = False
+        it.leaf = True
+        return it
+
+    def m_len(_):
+        return len(h)
+
+    def m_raw(_):
+        ret = EL
+        for k, v in h.items():
+            ret = [[unbox(k), [v, EL]], ret]
+        return ret
+
+    def m_set(args):
+        try:
+            k, (v, _) = args
+        except (TypeError, ValueError):
+            raise SyntaxError("expected key and value") from None
+        h[key(k, True)] = v
+        return EL
+
+    methods = {}
+    for name, f in (
+        ("known", m_known),
+        ("del", m_del),
+        ("get", m_get),
+        ("iter", m_iter),
+        ("len", m_len),
+        ("raw", m_raw),
+        ("set", m_set),
+    ):
+        methods[ctx.symbol(name)] = f
+
+    def dispatch(ctx):
+        try:
+            m, args = ctx.argl
+        except TypeError:
+            raise SyntaxError("expected method") from None
+        f = methods.get(m)
+        if f is None:
+            raise error("unknown method")
+        ctx.val = f(args)
+        return ctx.cont
+
+    def snapshot_():
+        ## the items oldest first, see snapshot_dump() in lcore.py
+        name = "table$eq?" if compare is op_eq else "table$equal?"
+        return name, hash_list([[unbox(k), [v, EL]] for k, v in h.items()])
+
+    def fill(items):
+        while items is not EL:
+            m_set(items[0])
+            items = items[1]
+
+    dispatch.special = dispatch.ffi = False
+    dispatch.leaf = True
+    dispatch.snapshot_ = snapshot_
+    return dispatch, fill
+
+
+## }}}
+## {{{ lists
+
+
+def list_copy(x, tail):
+    ## copy the spine of x onto tail
+    if x.__class__ is not list:
+        if x is EL:
+            return tail
+        raise TypeError(f"expected list, got {x!r}")
+    h = t = [x[0], EL]
+    x = x[1]
+    while x.__class__ is list:
+        n = [x[0], EL]
+        t[1] = n
+        t = n
+        x = x[1]
+    if x is not EL:
+        raise TypeError(f"expected list, got {x!r}")
+    t[1] = tail
+    return h
+
+
+def list_tail(x, k):
+    if intcheck(k) < 0:
+        raise IndexError(f"negative index {k}")
+    for _ in range(k):
+        if x.__class__ is not list:
+            raise IndexError(f"index {k} out of range")
+        x = x[1]
+    return x
+
+
+@leaf
+@glbl("append")
+@glbl("join")
+def op_append(ctx):
+    ## all but the last arg are copied, the last one is shared
+    a = ctx.argl
+    if a is EL:
+        ctx.val = EL
+        return ctx.cont
+    args = []
+    while a is not EL:
+        x, a = a
+        args.append(x)
+    ret = args.pop()
+    for x in reversed(args):
+        ret = list_copy(x, ret)
+    ctx.val = ret
+    return ctx.cont
+
+
+@leaf
+@glbl("last")
+def op_last(ctx):
+    x = ctx.unpack1()
+    if x.__class__ is not list:
+        got = "()" if x is EL else repr(x)
+        raise TypeError(f"expected non-empty list, got {got}")
+    while x[1].__class__ is list:
+        x = x[1]
+    ctx.val = x[0]
+    return ctx.cont
+
+
+@leaf
+@glbl("length")
+def op_length(ctx):
+    x = ctx.unpack1()
+    n = 0
+    while x.__class__ is list:
+        n += 1
+        x = x[1]
+    if x is not EL:
+        raise TypeError(f"expected list, got {x!r}")
+    ctx.val = n
+    return ctx.cont
+
+
+@leaf
+@glbl("list-copy")
+def op_list_copy(ctx):
+    ctx.val = list_copy(ctx.unpack1(), EL)
+    return ctx.cont
+
+
+@leaf
+@glbl("list-ref")
+def op_list_ref(ctx):
+    x, k = ctx.unpack2()
+    x = list_tail(x, k)
+    if x.__class__ is not list:
+        raise IndexError(f"index {k} out of range")
+    ctx.val = x[0]
+    return ctx.cont
+
+
+@leaf
+@glbl("list-tail")
+def op_list_tail(ctx):
+    ctx.val = list_tail(*ctx.unpack2())
+    return ctx.cont
+
+
+@leaf
+@glbl("reverse")
+def op_reverse(ctx):
+    x = ctx.unpack1()
+    ret = EL
+    while x.__class__ is list:
+        ret = [x[0], ret]
+        x = x[1]
+    if x is not EL:
+        raise TypeError(f"expected list, got {x!r}")
+    ctx.val = ret
+    return ctx.cont
+
+
 ## }}}
 ## {{{ ffi
 
@@ -806,6 +2269,223 @@ def op_ffi_time(args):
     return module_ffi(f(args), time)
 
 
+## }}}
+## {{{ parallel map
+
+## pmap and pfor-each send a procedure and chunks of a list to a pool of
+## worker processes, one pool per engine, started on first use. each
+## worker builds a base with the runtime once and runs every chunk in a
+## fresh context on top of it. the procedure travels as a snapshot, its
+## params, body, and envs plus whatever global bindings it can reach,
+## so it sees the same definitions there as here; the results come back
+## the same way. set LISP_WORKERS to change the number of workers from
+## os.cpu_count().
+
+POOLS = {}
+WORKER = None
+
+
+def pool_init(engine):
+    global WORKER  ## pylint: disable=global-statement
+    WORKER = engine, create_base(engine)
+
+
+def pool_run(snap, keep):
+    ## in a worker: apply proc to each item of a chunk
+    engine, base = WORKER
+    ctx = Context(engine, base=base)
+    proc, items = snapshot_load(ctx, snap)
+    ret = []
+    while items is not EL:
+        x, items = items
+        x = ctx.call(proc, x)
+        if keep:
+            ret.append(x)
+    return snapshot_dump(ctx, hash_list(ret), {}) if keep else None
+
+
+def pool_get(engine):
+    ## (workers, executor) for engine, started on first use
+    pool = POOLS.get(engine)
+    if pool is None:
+        ## pylint: disable=import-outside-toplevel
+        from concurrent.futures import ProcessPoolExecutor
+
+        n = int(os.environ.get("LISP_WORKERS", "0")) or os.cpu_count() or 1
+        pool = POOLS[engine] = n, ProcessPoolExecutor(
+            n, initializer=pool_init, initargs=(engine,)
+        )
+    return pool
+
+
+def pool_map(ctx, proc, items, keep):
+    ## proc applied to each item of the lisp list items in the workers,
+    ## as a lisp list if keep else ()
+    if getattr(proc, "special", True):
+        raise TypeError(f"expected procedure, got {proc!r}")
+    xs = pylist(items)
+    if not xs:
+        return EL
+    n, executor = pool_get(ctx.engine)
+    ## a few chunks per worker to even out the load
+    size = -(-len(xs) // (4 * n))
+    futures = []
+    for i in range(0, len(xs), size):
+        root = [proc, hash_list(xs[i : i + size])]
+        snap = snapshot_dump(ctx, root, snapshot_globals(ctx, root))
+        futures.append(executor.submit(pool_run, snap, keep))
+    ret = []
+    try:
+        for f in futures:
+            snap = f.result()
+            if keep:
+                ret.extend(pylist(snapshot_load(ctx, snap)))
+    finally:
+        for f in futures:
+            f.cancel()
+    return hash_list(ret)
+
+
+def pylist(x):
+    ## the items of a lisp list as a python list
+    ret = []
+    while x is not EL:
+        y, x = x
+        ret.append(y)
+    return ret
+
+
+@glbl("pfor-each")
+def op_pfor_each(ctx):
+    proc, items = ctx.unpack2()
+    ctx.val = pool_map(ctx, proc, items, False)
+    return ctx.cont
+
+
+@glbl("pmap")
+def op_pmap(ctx):
+    proc, items = ctx.unpack2()
+    ctx.val = pool_map(ctx, proc, items, True)
+    return ctx.cont
+
+
+## }}}
+## {{{ green threads
+
+## cooperative tasks in one trampoline, see the green threads section
+## of lcore.py. (spawn thunk) queues a task, (yield) lets the others
+## run, and (run-all) runs them all until they are finished or blocked.
+## tasks talk over channels: (send ch x) blocks until a receiver takes
+## x or there is room in the buffer, (recv ch) until there is a value.
+
+
+class Chan:
+    ## pylint: disable=too-few-public-methods
+    ## up to size sent values wait in buf. the tasks blocked on the
+    ## channel wait in recvq, or in sendq along with what they send,
+    ## each with the run queue it belongs to; see chan_waiter()
+    __slots__ = ("buf", "recvq", "sendq", "size")
+
+    def __init__(self, size):
+        self.buf = deque()
+        self.recvq = deque()
+        self.sendq = deque()
+        self.size = size
+
+
+def chancheck(x):
+    if x.__class__ is Chan:
+        return x
+    raise TypeError(f"expected chan, got {x!r}")
+
+
+def chan_waiter(ctx, q):
+    ## pop the first waiter in q that belongs to the current run queue,
+    ## None if there is none. the others were left behind by a run that
+    ## failed or by a nested run, see Context.run_end()
+    tasks = ctx.tasks
+    while q:
+        w = q.popleft()
+        if w[0] is tasks:
+            return w
+    return None
+
+
+@leaf
+@glbl("chan")
+def op_chan(ctx):
+    ## (chan) is unbuffered, (chan n) holds n values
+    args = ctx.argl
+    size = 0 if args is EL else ctx.unpack1()
+    if size.__class__ is not int or size < 0:
+        raise TypeError(f"expected size >= 0, got {size!r}")
+    ctx.val = Chan(size)
+    return ctx.cont
+
+
+@glbl("recv")
+def op_recv(ctx):
+    ch = chancheck(ctx.unpack1())
+    w = chan_waiter(ctx, ch.sendq) if ch.sendq else None
+    if ch.buf:
+        ctx.val = ch.buf.popleft()
+        if w is not None:
+            _, task, x = w
+            ch.buf.append(x)
+            ctx.tasks.append(task)
+        return ctx.cont
+    if w is not None:
+        _, task, ctx.val = w
+        ctx.tasks.append(task)
+        return ctx.cont
+    ch.recvq.append((task_queue(ctx), ctx.save()))
+    return k_task_next
+
+
+@glbl("run-all")
+def op_run_all(ctx):
+    if ctx.argl is not EL:
+        raise SyntaxError("expected no args")
+    ctx.push(ctx.cont)
+    ctx.cont = k_task_run_all
+    return k_task_run_all
+
+
+@glbl("send")
+def op_send(ctx):
+    ch, x = ctx.unpack2()
+    chancheck(ch)
+    ctx.val = EL
+    w = chan_waiter(ctx, ch.recvq) if ch.recvq else None
+    if w is not None:
+        task_wake(ctx, w[1], x)
+        return ctx.cont
+    if len(ch.buf) < ch.size:
+        ch.buf.append(x)
+        return ctx.cont
+    ch.sendq.append((task_queue(ctx), ctx.save(), x))
+    return k_task_next
+
+
+@leaf
+@glbl("spawn")
+def op_spawn(ctx):
+    proc = ctx.unpack1()
+    if getattr(proc, "special", True):
+        raise TypeError(f"expected procedure, got {proc!r}")
+    task_queue(ctx).append(task_new(ctx, proc))
+    ctx.val = EL
+    return ctx.cont
+
+
+@glbl("yield")
+def op_yield(ctx):
+    if ctx.argl is not EL:
+        raise SyntaxError("expected no args")
+    ctx.val = EL
+    return task_switch(ctx)
+
+
 ## }}}
 ## {{{ lisp runtime
 
@@ -842,35 +2522,9 @@ RUNTIME = r"""
     )
 )
 
-;; }}}
-;; {{{ last
-
-(define (last lst)
-    (if
-        (null? (cdr lst))
-        (car lst)
-        (last (cdr lst))
-    )
-)
-
-;; }}}
-;; {{{ bitwise ops
-
-;; bitwise ops from nand
-(define (bnot x)   (nand x x))
-(define (band x y) (bnot (nand x y)))
-(define (bor  x y) (nand (bnot x) (bnot y)))
-(define (bxor x y) (band (nand x y) (bor x y)))
-
 ;; }}}
 ;; {{{ arithmetic
 
-(define (+ x y) (- x (- y)))
-(define add +)
-
-;; oh, mod
-(define (% n d) (- n (* d (/ n d))))
-
 ;; absolute value
 (define (abs x)
     (if
@@ -889,62 +2543,9 @@ RUNTIME = r"""
     )
 )
 
-;; unsigned shifts
-(define (lshift x n)
-    (cond
-        ((equal? n 0)   x)
-        ((equal? n 1)   (+ x x))
-        (#t             (lshift x (lshift x 1) (- n 1)))
-    )
-)
-
-(define (rshift x n)
-    (cond
-        ((equal? n 0)   x)
-        ((equal? n 1)   (/ x 2))
-        (#t             (rshift x (rshift x 1) (- n 1)))
-    )
-)
-
-;; }}}
-;; {{{ comparison predicates
-
-(define (<= x y) (if (< x y) #t (if (equal? x y) #t ())))
-(define (>= x y) (not (< x y)))
-(define (>  x y) (< y x))
-(define (!= x y) (not (equal? x y)))
-
 ;; }}}
 ;; {{{ and or not
 
-(special (and & __special_and_args__)
-    ((lambda (c)
-        (cond
-            ((null? __special_and_args__) ())
-            ((null? (cdr __special_and_args__))
-                (eval (car __special_and_args__)))
-            ((eval (car __special_and_args__)) (begin
-                (set! __special_and_args__ (cdr __special_and_args__))
-                (c c)
-            ))
-            (#t ())
-        )
-    ) (call/cc) )
-)
-
-(special (or & __special_or_args__)
-    ((lambda (c)
-        (cond
-            ((null? __special_or_args__) ())
-            ((eval (car __special_or_args__)) #t)
-            (#t (begin
-                (set! __special_or_args__ (cdr __special_or_args__))
-                (c c)
-            ))
-        )
-    ) (call/cc) )
-)
-
 (define not null?)
 
 ;; }}}
@@ -958,20 +2559,6 @@ RUNTIME = r"""
     )
 )
 
-;; }}}
-;; {{{ reverse
-
-(define (reverse l)
-    (define (rev x y)
-        (if
-            (null? x)
-            y
-            (rev (cdr x) (cons (car x) y))
-        )
-    )
-    (rev l ())
-)
-
 ;; }}}
 ;; {{{ iter and enumerate
 
@@ -1009,23 +2596,6 @@ RUNTIME = r"""
     next
 )
 
-;; }}}
-;; {{{ length
-
-(define (length l)
-    (define n 0)
-    (define c (call/cc))
-    (if
-        (null? l)
-        n
-        (begin
-            (set! n (+ n 1))
-            (set! l (cdr l))
-            (c c)
-        )
-    )
-)
-
 ;; }}}
 ;; {{{ fold, transpose, map
 ;; sicp p.158-165 with interface tweaks
@@ -1072,97 +2642,21 @@ RUNTIME = r"""
 )
 
 ;; }}}
-;; {{{ join
-
-(define (join x y)
-    (if
-        (null? x)
-        y
-        (begin
-            (define ht (join$start (car x)))
-            (join$1 (cdr x) ht)
-            (set-cdr! (cdr ht) y)
-            (car ht)
-        )
-    )
-)
-
-(define (join$start x)
-    (define n (cons x ()))
-    (cons n n)
-)
-
-(define (join$1 x ht)
-    (if
-        (null? x)
-        (car ht)
-        (begin
-            (define n (cons (car x) ()))
-            (set-cdr! (cdr ht) n)
-            (set-cdr! ht n)
-            (join$1 (cdr x) ht)
-        )
-    )
-)
-
-;; }}}
-;; {{{ let
-
-(special (let __special_let_vdefs__ __special_let_body__)
-    (eval (let$ __special_let_vdefs__ __special_let_body__) 1))
-
-(define (let$ vdefs body)
-    (define vdecls (transpose vdefs))
-    (define vars (car vdecls))
-    (define vals (cadr vdecls))
-    `((lambda (,@vars) ,body) ,@vals)
-)
-
-;; }}}
-;; {{{ let*
-
-(special (let* __special_lets_vdefs__ __special_lets_body__)
-    (eval (let*$ __special_lets_vdefs__ __special_lets_body__) 1))
+;; {{{ associative table
 
-(define (let*$ vdefs body)
+(define (table compare)
     (if
-        (null? vdefs)
-        body
-        (begin
-            (define kv (car vdefs))
-            (set! vdefs (cdr vdefs))
-            (define k (car kv))
-            (define v (cadr kv))
-          `((lambda (,k) ,(let*$ vdefs body)) ,v)
-        )
+        (or (equal? compare eq?) (equal? compare equal?))
+        (table$hash compare)
+        (table$alist compare)
     )
 )
 
-;; }}}
-;; {{{ letrec
-;; i saw this (define x ()) ... (set! x value) on stackoverflow somewhere
-
-(special (letrec __special_letrec_decls__ __special_letrec_body__)
-    (eval (letrec$ __special_letrec_decls__ __special_letrec_body__) 1))
-
-(define (letrec$ decls & body)
-    (define names (map1 car decls))
-    (define values (map1 cadr decls))
-    (define (declare var) `(define ,var ()))
-    (define (initialize var-value) `(set! ,(car var-value) ,(cadr var-value)))
-    (define (declare-all) (map1 declare names))
-    (define (initialize-all) (map1 initialize decls))
-    `((lambda () (begin ,@(declare-all) ,@(initialize-all) ,@body)))
-)
-
-;; }}}
-;; {{{ associative table
-
-(define (table compare)
+(define (table$alist compare)
     (define items ())
     (define (dispatch m & args)
         (cond
-            ((eq? m 'known) (not (null? (table$find items key compare))))
+            ((eq? m 'known) (not (null? (table$find items (car args) compare))))
             ((eq? m 'del) (set! items (table$delete items (car args) compare)))
             ((eq? m 'get) (begin
                 (let* (
@@ -1347,10 +2841,102 @@ RUNTIME = r"""
 ## }}}
 
 
-def main():
-    ctx = Context()
+## the engines that start faster from the snapshot: restoring it takes
+## about 60% of the time it takes to evaluate RUNTIME under interp and
+## 80% under compiled, but about the same under vm, see startup.py
+SNAPSHOT_ENGINES = ("interp", "compiled")
+
+
+def init_runtime(ctx, snapshot=True):
+    ## evaluate RUNTIME in ctx or, faster on SNAPSHOT_ENGINES, restore the
+    ## global env it creates from a snapshot saved by an earlier run
+    if not (snapshot and ctx.engine in SNAPSHOT_ENGINES):
+        parse(ctx, RUNTIME, ctx.leval)
+        return
+    key = snapshot_key(RUNTIME)
+    snap = cache_read(__file__, "runtime.snap", key)
+    if snap is not None:
+        snapshot_load(ctx, snap)
+        return
     parse(ctx, RUNTIME, ctx.leval)
-    return lmain(ctx)
+    try:
+        cache_write(__file__, "runtime.snap", key, snapshot_dump(ctx))
+    except TypeError:
+        pass
+
+
+def create_base(engine="interp", snapshot=True):
+    ## the primitives and RUNTIME, frozen for Context(base=...)
+    ctx = Context(engine)
+    init_runtime(ctx, snapshot)
+    return Base(ctx)
+
+
+def main():
+    ## pylint: disable=too-many-branches
+    engine = "interp"
+    cache = snapshot = True
+    mapped = stats = False
+    profile = None
+    while len(sys.argv) > 1 and sys.argv[1].startswith("--"):
+        opt = sys.argv.pop(1)
+        if opt.startswith("--engine="):
+            engine = opt[9:]
+        elif opt == "--no-cache":
+            cache = False
+        elif opt == "--no-snapshot":
+            snapshot = False
+        elif opt == "--mmap":
+            mapped = True
+        elif opt == "--stats":
+            stats = True
+        elif opt == "--profile" or opt.startswith("--profile="):
+            profile = opt[10:] or "lisp"
+        else:
+            raise SystemExit(f"unknown option {opt!r}")
+    ctx = Context(engine)
+    if profile:
+        ## the runtime's defines have to run to get profiled
+        ctx.prof = Profiler()
+        snapshot = False
+    init_runtime(ctx, snapshot)
+    if stats:
+        ctx.instrument()
+    try:
+        return lmain(ctx, cache=cache, mapped=mapped)
+    finally:
+        if stats:
+            print_stats(ctx.stats())
+        if profile:
+            print_profile(ctx.prof, profile)
+
+
+def print_stats(st, top=20):
+    ## summary of ctx.stats() on stderr for --stats
+    def p(*args):
+        print(*args, file=sys.stderr)
+
+    p(f"{st['runs']} runs, {st['steps']} steps, {st['time']:.3f}s")
+    p("bounces per continuation:")
+    for name, n in list(st["counts"].items())[:top]:
+        p(f"{n:12d}  {name}")
+    p("runs by steps:")
+    for limit, n in st["hist"].items():
+        p(f"{n:12d}  < {limit}")
+
+
+def print_profile(prof, name, top=20):
+    ## save prof for pstats and flamegraphs, summary on stderr
+    import pstats  ## pylint: disable=import-outside-toplevel
+
+    prof.dump_stats(name + ".pstats")
+    prof.dump_collapsed(name + ".folded")
+    if not prof.stats:
+        ## pstats.Stats won't load an empty profile
+        print("no lisp calls were profiled", file=sys.stderr)
+        return
+    st = pstats.Stats(name + ".pstats", stream=sys.stderr)
+    st.sort_stats("tottime").print_stats(top)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+##
+## sisoap - python lisp: solution in search of a problem
+##       https://github.com/minmus-9/sisoap
+## Copyright (C) 2025  Mark Hays (github:minmus-9)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"parser throughput benchmark"
+
+## pylint: disable=invalid-name
+## XXX pylint: disable=missing-docstring
+
+import gc
+import glob
+import os
+import sys
+import time
+
+from lcore import Context, Parser
+from lisp import RUNTIME
+
+
+def corpus(size):
+    ## the runtime and the examples, repeated to about size bytes
+    here = os.path.dirname(os.path.abspath(__file__))
+    texts = [RUNTIME]
+    for path in sorted(glob.glob(os.path.join(here, "examples", "*.lisp"))):
+        with open(path, "r", encoding="utf-8") as fp:
+            texts.append(fp.read())
+    text = "\n".join(texts)
+    return text * max(1, size // len(text))
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 20
+    text = corpus(size)
+    mb = len(text.encode("utf-8")) / (1 << 20)
+    ctx = Context()
+    for chunk in (None, 1 << 16, 1 << 10):
+        best = None
+        for _ in range(3):
+            forms = []
+            gc.collect()
+            p = Parser(ctx, forms.append)
+            t = time.perf_counter()
+            if chunk is None:
+                p.feed(text)
+            else:
+                for i in range(0, len(text), chunk):
+                    p.feed(text[i : i + chunk])
+            p.feed(None)
+            t = time.perf_counter() - t
+            best = t if best is None else min(best, t)
+        what = "whole" if chunk is None else f"{chunk}-char chunks"
+        print(
+            f"{what:<20} {mb:6.2f} MB {len(forms):7d} forms"
+            f" {mb / best:7.2f} MB/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
+
+## EOF
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+##
+## sisoap - python lisp: solution in search of a problem
+##       https://github.com/minmus-9/sisoap
+## Copyright (C) 2025  Mark Hays (github:minmus-9)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"startup benchmark"
+
+## pylint: disable=invalid-name
+## XXX pylint: disable=missing-docstring
+
+import os
+import subprocess
+import sys
+import time
+
+from lcore import ENGINES
+from lisp import SNAPSHOT_ENGINES
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LISP = os.path.join(HERE, "lisp.py")
+
+## a whole run is dominated by starting python and importing, so this
+## times create_base() on its own as well, in a fresh process each time
+BASE = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+import lisp
+t = time.perf_counter()
+lisp.create_base(sys.argv[2], sys.argv[3] == "1")
+print(time.perf_counter() - t)
+"""
+
+
+def best(cmd, n):
+    ## best wall time of n runs of cmd
+    ret = None
+    for _ in range(n):
+        t = time.perf_counter()
+        subprocess.run(cmd, check=True)
+        t = time.perf_counter() - t
+        ret = t if ret is None else min(ret, t)
+    return ret
+
+
+def best_base(engine, snapshot, n):
+    ## best time of n create_base() calls, each in a new process
+    cmd = [sys.executable, "-c", BASE, HERE, engine, str(int(snapshot))]
+    ret = None
+    for _ in range(n):
+        out = subprocess.run(cmd, check=True, capture_output=True).stdout
+        t = float(out)
+        ret = t if ret is None else min(ret, t)
+    return ret
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    lisp = [sys.executable, LISP]
+    ## prime the snapshot and the .pyc files
+    best(lisp + [os.devnull], 1)
+    t = best([sys.executable, "-c", "pass"], n)
+    print(f"{'python -c pass':<32} {t * 1e3:8.2f} ms")
+    for engine in ENGINES:
+        snapshots = (True, False) if engine in SNAPSHOT_ENGINES else (False,)
+        for snapshot in snapshots:
+            args = [f"--engine={engine}"]
+            if not snapshot:
+                args.append("--no-snapshot")
+            t = best(lisp + args + [os.devnull], n)
+            b = best_base(engine, snapshot, n)
+            print(
+                f"{' '.join(args):<32} {t * 1e3:8.2f} ms"
+                f"  create_base {b * 1e3:6.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
+
+## EOF